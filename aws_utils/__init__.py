@@ -0,0 +1,22 @@
+# The wrapper classes are imported on first access, so "import aws_utils" stays cheap
+_EXPORTS = {
+    'AsyncConnection': 'aws_utils.aio',
+    'AsyncLambda': 'aws_utils.aio',
+    'AsyncS3': 'aws_utils.aio',
+    'Connection': 'aws_utils.dynamodb',
+    'Lambda': 'aws_utils.lambda_function',
+    'Policy': 'aws_utils.iam',
+    'Provisioner': 'aws_utils.iam',
+    'Role': 'aws_utils.iam',
+    'S3': 'aws_utils.s3'
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    return getattr(importlib.import_module(_EXPORTS[name]), name)
@@ -0,0 +1,141 @@
+import asyncio
+import functools
+import inspect
+import threading
+from aws_utils import clients, dynamodb, lambda_function, s3
+
+# One thread per connection of the shared connection pools: more threads would only wait for a connection
+default_max_workers = clients.default_max_pool_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+_DONE = object()
+
+
+def get_executor():
+
+    """
+    :return: the bounded thread pool shared by every async wrapper, created on first use
+    """
+
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                _executor = ThreadPoolExecutor(max_workers=default_max_workers, thread_name_prefix='aws_utils')
+    return _executor
+
+
+async def run(func, *args, executor=None, **kwargs):
+
+    """
+    Run a blocking call on the bounded executor without blocking the event loop.
+
+    :param func: Callable to run
+    :param executor: Executor to run func on (optional, default = the shared executor)
+    :return: the return value of func
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or get_executor(), functools.partial(func, *args, **kwargs))
+
+
+class AsyncIterator:
+    def __init__(self, iterable, executor=None):
+
+        """
+        Async iterator over a blocking iterable; every next() runs on the executor. Other attributes are
+        read from the iterable, e.g. the stats of a ParallelScan.
+
+        :param iterable: Blocking iterable, e.g. a generator of the sync wrappers
+        :param executor: Executor to iterate on (optional, default = the shared executor)
+        """
+
+        self.iterable = iterable
+        self.executor = executor
+        self._iterator = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = await run(iter, self.iterable, executor=self.executor)
+        item = await run(next, self._iterator, _DONE, executor=self.executor)
+        if item is _DONE:
+            raise StopAsyncIteration
+        return item
+
+    def __getattr__(self, name):
+        return getattr(self.iterable, name)
+
+
+def _coroutine_method(name, func):
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await run(getattr(self.sync, name), *args, executor=self.executor, **kwargs)
+    return method
+
+
+def _iterator_method(name, func):
+    @functools.wraps(func)
+    def method(self, *args, **kwargs):
+        # Creating the generator is cheap, the calls happen when it is iterated
+        return AsyncIterator(getattr(self.sync, name)(*args, **kwargs), executor=self.executor)
+    return method
+
+
+class _AsyncWrapper:
+    wrapped = None
+    # Methods that return a blocking iterable without being a generator function
+    iterators = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, func in vars(cls.wrapped).items():
+            if name.startswith('_') or not inspect.isfunction(func) or name in vars(cls):
+                continue
+            if inspect.isgeneratorfunction(func) or name in cls.iterators:
+                setattr(cls, name, _iterator_method(name, func))
+            else:
+                setattr(cls, name, _coroutine_method(name, func))
+
+    def __init__(self, *args, executor=None, **kwargs):
+        self.sync = self.wrapped(*args, **kwargs)
+        self.executor = executor
+
+    def __getattr__(self, name):
+        return getattr(self.sync, name)
+
+
+class AsyncS3(_AsyncWrapper):
+
+    """
+    S3 with the same methods and return values, as coroutines (generators become async iterators).
+    Takes the arguments of S3 plus an optional executor.
+    """
+
+    wrapped = s3.S3
+
+
+class AsyncConnection(_AsyncWrapper):
+
+    """
+    dynamodb.Connection with the same methods and return values, as coroutines (generators and parallel_scan
+    become async iterators). Takes the arguments of Connection plus an optional executor.
+    """
+
+    wrapped = dynamodb.Connection
+    iterators = ('parallel_scan',)
+
+
+class AsyncLambda(_AsyncWrapper):
+
+    """
+    Lambda with the same methods and return values, as coroutines (execute_batch and map become async
+    iterators). Takes the arguments of Lambda plus an optional executor.
+    """
+
+    wrapped = lambda_function.Lambda
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=128, ttl=None, max_bytes=None, sizeof=len):
+
+        """
+        Thread safe least-recently-used cache with an optional time to live and size cap.
+
+        :param maxsize: Maximum number of entries, the least recently used entry is evicted first (default = 128)
+        :param ttl: Seconds an entry stays valid (optional, default = no expiry)
+        :param max_bytes: Maximum total size of the values (optional, default = no size cap)
+        :param sizeof: Callable returning the size of a value, only used with max_bytes (optional, default = len)
+        """
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+
+        """
+        :param key: Key of the entry
+        :param default: Value returned when the key is missing or expired (optional)
+        :return: the cached value, or default
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+
+        """
+        :param key: Key of the entry
+        :param value: Value to cache
+        :param ttl: Seconds this entry stays valid (optional, default = ttl of the cache)
+        """
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._remove(key)
+            # A value larger than the whole cache would only evict everything else
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires, size)
+            self.bytes += size
+            while len(self._entries) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+
+    def pop(self, key, default=None):
+
+        """
+        :param key: Key of the entry to invalidate
+        :param default: Value returned when the key is missing (optional)
+        :return: the removed value, or default
+        """
+
+        with self._lock:
+            entry = self._remove(key)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+
+        """
+        :return: {"hits", "misses", "hit_rate", "evictions", "size", "bytes"} counters of the cache
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'bytes': self.bytes
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared by Lambda.get, Role.get and Policy.get. The control-plane APIs behind them are heavily rate limited,
+# while the metadata rarely changes; the wrappers invalidate entries on their own writes.
+metadata_cache = LRUCache(maxsize=4096, ttl=300)
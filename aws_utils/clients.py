@@ -0,0 +1,184 @@
+import copy
+import threading
+import weakref
+
+# Default size of the HTTP connection pool of every client. botocore defaults to 10, which is too small
+# for the bulk operations of the wrappers. Connections are only opened when they are needed.
+default_max_pool_connections = 50
+
+# general.call_with_backoff owns the retries of the wrapper calls: botocore retrying every attempt as well would
+# multiply the calls under throttling. Clients that are used outside call_with_backoff, like the one of the S3
+# transfers, pass retries explicitly.
+default_retries = {'mode': 'standard', 'total_max_attempts': 1}
+
+_session = None
+_generation = 0
+_clients = {}
+_resources = threading.local()
+_lock = threading.Lock()
+_hooks = []
+# The clients of the per-thread resources, so hooks added later reach them as well
+_resource_clients = weakref.WeakSet()
+
+
+def _config_key(service, region, pool_size, config):
+    return service, region, pool_size, tuple(sorted((name, repr(value)) for name, value in config.items()))
+
+
+def client_config(max_pool_connections=None, **config):
+
+    """
+    Return the botocore Config of the registry's clients, for a client that has to be created outside the registry.
+
+    :param max_pool_connections: Size of the HTTP connection pool (optional, default = default_max_pool_connections)
+    :param config: Other botocore Config options (optional, retries default to default_retries)
+    :return: botocore.config.Config
+    """
+
+    from botocore.config import Config
+
+    config.setdefault('retries', default_retries)
+    # botocore changes the retries dict it is given, which would change default_retries or the key of a client
+    return Config(max_pool_connections=max_pool_connections or default_max_pool_connections, **copy.deepcopy(config))
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        import boto3
+
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service, region=None, max_pool_connections=None, **config):
+
+    """
+    Return the shared low-level client for a service. Clients are created once per
+    (service, region, config) on first use and are thread safe, so every wrapper can share them.
+
+    :param service: Name of the AWS service, e.g. s3
+    :param region: Region of the client (optional, default = region of the environment)
+    :param max_pool_connections: Size of the HTTP connection pool (optional, default = default_max_pool_connections)
+    :param config: Other botocore Config options, e.g. read_timeout=10 (optional)
+    :return: botocore client
+    """
+
+    pool_size = max_pool_connections or default_max_pool_connections
+    config.setdefault('retries', default_retries)
+    key = _config_key(service, region, pool_size, config)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service, region_name=region, config=client_config(pool_size, **config))
+                run_hooks(client)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service, region=None, max_pool_connections=None, **config):
+
+    """
+    Return the shared resource for a service. boto3 resources are not thread safe, so a resource is
+    created once per thread and (service, region, config).
+
+    :param service: Name of the AWS service, e.g. dynamodb
+    :param region: Region of the resource (optional, default = region of the environment)
+    :param max_pool_connections: Size of the HTTP connection pool (optional, default = default_max_pool_connections)
+    :param config: Other botocore Config options (optional)
+    :return: boto3 service resource
+    """
+
+    pool_size = max_pool_connections or default_max_pool_connections
+    config.setdefault('retries', default_retries)
+    key = _config_key(service, region, pool_size, config)
+    if getattr(_resources, 'generation', None) != _generation:
+        _resources.cache = {}
+        _resources.generation = _generation
+    resources = _resources.cache
+
+    resource = resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _get_session().resource(service, region_name=region, config=client_config(pool_size, **config))
+            run_hooks(resource.meta.client)
+            _resource_clients.add(resource.meta.client)
+        resources[key] = resource
+    return resource
+
+
+def add_hook(hook):
+
+    """
+    Call hook(client) for every client of the registry, the existing ones and every client created later,
+    e.g. to register botocore event handlers.
+
+    :param hook: Callable that receives a botocore client
+    """
+
+    with _lock:
+        if hook in _hooks:
+            return
+        _hooks.append(hook)
+        existing = list(_clients.values()) + list(_resource_clients)
+    for client in existing:
+        hook(client)
+
+
+def run_hooks(client):
+
+    """
+    Apply the hooks of add_hook to a client that was created outside the registry.
+
+    :param client: botocore client
+    :return: client
+    """
+
+    for hook in list(_hooks):
+        hook(client)
+    return client
+
+
+def clear():
+
+    """
+    Drop every cached client and resource, e.g. after the credentials in the environment changed.
+    """
+
+    global _session, _generation
+    with _lock:
+        _clients.clear()
+        _session = None
+        _generation += 1
+
+
+class LazyClient:
+    def __init__(self, service, regional=True, **config):
+
+        """
+        Class attribute that resolves to the shared client of the registry the first time it is used on an
+        instance, so constructing a wrapper does not import boto3 or load the service model.
+
+        :param service: Name of the AWS service, e.g. s3
+        :param regional: Create the client in the region attribute of the instance (optional, default = True)
+        :param config: Options passed to get_client (optional)
+        """
+
+        self.service = service
+        self.regional = regional
+        self.config = config
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        region = getattr(instance, 'region', None) if self.regional else None
+        client = get_client(self.service, region, **self.config)
+        # Cache on the instance; assigning the attribute (e.g. a stubbed client) overrides it as before
+        instance.__dict__[self.name] = client
+        return client
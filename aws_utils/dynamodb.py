@@ -1,8 +1,36 @@
-import boto3
-from boto3.dynamodb.conditions import Attr
+import collections.abc
+import copy
+import functools
+import itertools
+import threading
+import time
 import json
+import re
+from aws_utils import clients, general
+from aws_utils.cache import LRUCache
+
+# Operators that DynamoDB accepts on a sort key in a KeyConditionExpression, in order of preference
+RANGE_KEY_OPERATORS = ('eq', 'between', 'begins_with', 'lt', 'le', 'gt', 'ge')
+
+# Maximum number of keys of a batch_get_item and of requests of a batch_write_item call
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+
+# Errors of describe_table that do not go away by describing the table again
+DEFINITIVE_DESCRIBE_ERRORS = {'AccessDeniedException', 'ResourceNotFoundException', 'UnrecognizedClientException'}
+
+_key_schemas = {}
+_key_schemas_lock = threading.Lock()
+
+# Compiled expressions keyed by the shape of the filters (attribute names and operators) or the projected attributes
+expression_cache = LRUCache(maxsize=512)
+
+_COMPARISON_OPERATORS = {'eq': '=', 'ne': '<>', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+_PATH_ELEMENT = re.compile(r'^(.*?)((?:\[[0-9]+\])*)$')
 
 def build_filter_expression(filters):
+    from boto3.dynamodb.conditions import Attr
+
     filter_expression = None
 # Dynamically build FilterExpression
     for attribute, condition in filters.items():
@@ -50,81 +78,970 @@ def build_filter_expression(filters):
     return filter_expression
 
 
+def _filter_shape_and_values(filters):
+    # One pass, so the values of in may be any iterable, e.g. a generator
+    shape = []
+    values = []
+    for attribute, condition in filters.items():
+        operators = []
+        for operator, value in condition.items():
+            arity = 0
+            if operator == 'in':
+                value = tuple(value)
+                arity = len(value)
+                values.extend(value)
+            elif operator == 'between':
+                values.extend(value)
+            elif operator not in ('attribute_exists', 'attribute_not_exists'):
+                values.append(value)
+            operators.append((operator, arity))
+        shape.append((attribute, tuple(operators)))
+    return tuple(shape), values
+
+
+def _name_path(attribute, placeholder, names):
+    # Mirror boto3: dots separate nested attributes and [n] selects a list element
+    path = []
+    for position, element in enumerate(attribute.split('.')):
+        name, indexes = _PATH_ELEMENT.match(element).groups()
+        name_placeholder = f"{placeholder}_{position}" if '.' in attribute else placeholder
+        names[name_placeholder] = name
+        path.append(name_placeholder + indexes)
+    return '.'.join(path)
+
+
+def _compile_filters(shape, prefix, key_condition):
+    names = {}
+    value_placeholders = []
+    conditions = []
+
+    def value():
+        placeholder = f":{prefix}{len(value_placeholders)}"
+        value_placeholders.append(placeholder)
+        return placeholder
+
+    for position, (attribute, operators) in enumerate(shape):
+        name = _name_path(attribute, f"#{prefix}{position}", names)
+        for operator, arity in operators:
+            if operator in _COMPARISON_OPERATORS and not (key_condition and operator == 'ne'):
+                conditions.append(f"{name} {_COMPARISON_OPERATORS[operator]} {value()}")
+            elif operator == 'between':
+                conditions.append(f"{name} BETWEEN {value()} AND {value()}")
+            elif operator == 'begins_with':
+                conditions.append(f"begins_with({name}, {value()})")
+            elif operator == 'in' and not key_condition:
+                if arity == 0:
+                    raise ValueError(f"Operator in needs at least one value for attribute {attribute}")
+                conditions.append(f"({' OR '.join(f'{name} = {value()}' for _ in range(arity))})")
+            elif operator == 'contains' and not key_condition:
+                conditions.append(f"contains({name}, {value()})")
+            elif operator == 'attribute_exists' and not key_condition:
+                conditions.append(f"attribute_exists({name})")
+            elif operator == 'attribute_not_exists' and not key_condition:
+                conditions.append(f"attribute_not_exists({name})")
+            elif key_condition:
+                raise ValueError(f"Unsupported key operator: {operator}")
+            else:
+                raise ValueError(f"Unsupported operator: {operator}")
+
+    return ' AND '.join(conditions), names, tuple(value_placeholders)
+
+
+def compile_filter_expression(filters, prefix='f', key_condition=False):
+    """
+    Compile filters in the format {attribute: {operator: value}} to expression strings.
+    The compiled expression is cached by the shape of the filters, so only the values are bound per call.
+    Returns (expression, ExpressionAttributeNames, ExpressionAttributeValues). Use a different prefix for
+    every expression that is sent in the same request.
+    """
+    shape, values = _filter_shape_and_values(filters)
+    cache_key = ('filter', prefix, key_condition, shape)
+    compiled = expression_cache.get(cache_key)
+    if compiled is None:
+        compiled = _compile_filters(shape, prefix, key_condition)
+        expression_cache.put(cache_key, compiled)
+
+    expression, names, value_placeholders = compiled
+    return expression, dict(names), dict(zip(value_placeholders, values))
+
+
+def compile_key_condition_expression(key_filters, prefix='k'):
+    """
+    Same as compile_filter_expression, restricted to the operators of a KeyConditionExpression.
+    """
+    return compile_filter_expression(key_filters, prefix=prefix, key_condition=True)
+
+
+def compile_projection_expression(attributes, prefix='p'):
+    """
+    Compile a list of attribute names to a ProjectionExpression, cached by the attribute names.
+    Returns (ProjectionExpression, ExpressionAttributeNames).
+    """
+    cache_key = ('projection', prefix, tuple(attributes))
+    compiled = expression_cache.get(cache_key)
+    if compiled is None:
+        names = {}
+        paths = [_name_path(attribute, f"#{prefix}{position}", names) for position, attribute in enumerate(attributes)]
+        compiled = (', '.join(paths), names)
+        expression_cache.put(cache_key, compiled)
+
+    projection_expression, names = compiled
+    return projection_expression, dict(names)
+
+
+def serialize_item(item):
+    """
+    Convert a python dict to the DynamoDB JSON format of the low-level client.
+    """
+    serializer = _type_serializer()
+    return {name: serializer.serialize(value) for name, value in item.items()}
+
+
+def deserialize_value(value):
+    """
+    Convert one attribute value in DynamoDB JSON format to python, with the same result as boto3's
+    TypeDeserializer but dispatching directly on the type descriptor.
+    """
+    for descriptor, data in value.items():
+        return (_decoders or _load_decoders())[descriptor](data)
+    raise TypeError('Value must be a nonempty dictionary whose key is a valid dynamodb type.')
+
+
+def deserialize_item(item):
+    """
+    Convert an item in DynamoDB JSON format to a python dict, the same way the resource layer does.
+    """
+    return {name: deserialize_value(value) for name, value in item.items()}
+
+
+def _convert_request_items(request_items, convert):
+    # Applies convert to the keys and items nested in the RequestItems of batch_get_item and batch_write_item
+    converted = {}
+    for table_name, requests in request_items.items():
+        if isinstance(requests, dict):
+            converted[table_name] = dict(requests, Keys=[convert(key) for key in requests['Keys']])
+            continue
+        converted[table_name] = [
+            {'PutRequest': {'Item': convert(request['PutRequest']['Item'])}} if 'PutRequest' in request
+            else {'DeleteRequest': {'Key': convert(request['DeleteRequest']['Key'])}}
+            for request in requests
+        ]
+    return converted
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+
+@functools.cache
+def _type_serializer():
+    from boto3.dynamodb.types import TypeSerializer
+
+    return TypeSerializer()
+
+
+_decoders = None
+
+
+def _load_decoders():
+    # Built on first use, so importing this module does not import boto3
+    global _decoders
+    from boto3.dynamodb.types import DYNAMODB_CONTEXT, Binary
+
+    _decoders = {
+        'S': lambda data: data,
+        'N': DYNAMODB_CONTEXT.create_decimal,
+        'B': Binary,
+        'BOOL': lambda data: data,
+        'NULL': lambda data: None,
+        'SS': set,
+        'NS': lambda data: {DYNAMODB_CONTEXT.create_decimal(number) for number in data},
+        'BS': lambda data: {Binary(binary) for binary in data},
+        'L': lambda data: [deserialize_value(value) for value in data],
+        'M': lambda data: {name: deserialize_value(value) for name, value in data.items()}
+    }
+    return _decoders
+
+
+class LazyItem(collections.abc.Mapping):
+    def __init__(self, raw):
+
+        """
+        Read-only item that keeps the DynamoDB JSON of the low-level client and only deserializes an
+        attribute the first time it is accessed.
+
+        :param raw: Item in DynamoDB JSON format, e.g. {"id": {"S": "abc"}}
+        """
+
+        self.raw = raw
+        self._values = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            value = self._values[name] = deserialize_value(self.raw[name])
+            return value
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __repr__(self):
+        return f"LazyItem({dict(self)!r})"
+
+
+def _update_placeholders(position):
+    return f"#u{position}", f":u{position}", f"#u{position} = :u{position}"
+
+
+# Placeholders of the first attributes of an update, formatting them per call costs more than the rest of the build
+_UPDATE_PLACEHOLDERS = tuple(_update_placeholders(position) for position in range(32))
+
+
 def build_update_expression(update_data):
     """
     Build the UpdateExpression dynamically based on input data.
+    Placeholders are positional, so any attribute name is valid. Not cached: with the placeholder strings
+    formatted up front, building the expression is cheaper than a cache lookup.
     """
-    update_expression = "SET "
+    assignments = []
     expression_attribute_values = {}
     expression_attribute_names = {}
+    # Using ExpressionAttributeNames to avoid reserved words
+    for position, (key, value) in enumerate(update_data.items()):
+        name, placeholder, assignment = (_UPDATE_PLACEHOLDERS[position] if position < len(_UPDATE_PLACEHOLDERS)
+                                         else _update_placeholders(position))
+        assignments.append(assignment)
+        expression_attribute_values[placeholder] = value
+        expression_attribute_names[name] = key
+
+    return "SET " + ", ".join(assignments), expression_attribute_values, expression_attribute_names
+
+
+def describe_key_schema(client, table_name):
+    """
+    Describe the table once per region and cache the key schema of the table and of its indexes.
+    Returns a list of {"index": index name or None for the table, "hash": attribute, "range": attribute or None,
+    "projection": projection type}, or an empty list when the table cannot be described. Only a definitive
+    failure (see DEFINITIVE_DESCRIBE_ERRORS) is cached, throttling and transient errors are retried and described
+    again on the next call.
+    """
+    cache_key = (client.meta.region_name, table_name)
+    with _key_schemas_lock:
+        if cache_key in _key_schemas:
+            return _key_schemas[cache_key]
+
+    try:
+        table = general.call_with_backoff(client.describe_table, TableName=table_name)['Table']
+    except Exception as e:
+        if general.error_code(e) not in DEFINITIVE_DESCRIBE_ERRORS:
+            return []
+        indexes = []
+    else:
+        def index_schema(name, key_schema, projection):
+            keys = {key['KeyType']: key['AttributeName'] for key in key_schema}
+            return {'index': name, 'hash': keys['HASH'], 'range': keys.get('RANGE'), 'projection': projection}
+
+        indexes = [index_schema(None, table['KeySchema'], 'ALL')]
+        for index in table.get('LocalSecondaryIndexes', []) + table.get('GlobalSecondaryIndexes', []):
+            indexes.append(index_schema(index['IndexName'], index['KeySchema'], index['Projection']['ProjectionType']))
+
+    with _key_schemas_lock:
+        _key_schemas[cache_key] = indexes
+    return indexes
+
+
+def plan_query(indexes, filters):
+    """
+    Pick the index that can serve the filters with a query instead of a scan.
+    Returns (index name or None, key filters, remaining filters), or None when every index needs a scan.
+    Only indexes that project all attributes are considered, so a query returns the same items as a scan.
+    Secondary indexes are sparse: an index with a sort key only holds the items that have it, so it is only
+    considered when the filters constrain that sort key or require attribute_exists on it.
+    """
+    best = None
+    best_score = 0
+    for index in indexes:
+        if index['projection'] != 'ALL' or 'eq' not in filters.get(index['hash'], {}):
+            continue
+
+        key_filters = {index['hash']: {'eq': filters[index['hash']]['eq']}}
+        range_key = index['range']
+        if range_key is not None:
+            range_operator = next((operator for operator in RANGE_KEY_OPERATORS
+                                   if operator in filters.get(range_key, {})), None)
+            if range_operator is not None:
+                key_filters[range_key] = {range_operator: filters[range_key][range_operator]}
+            elif index['index'] is not None and 'attribute_exists' not in filters.get(range_key, {}):
+                continue
+
+        remaining_filters = {}
+        for attribute, condition in filters.items():
+            # Every item of an index has its key attributes
+            condition = {operator: value for operator, value in condition.items()
+                         if operator not in key_filters.get(attribute, {})
+                         and not (attribute == range_key and operator == 'attribute_exists')}
+            if condition:
+                remaining_filters[attribute] = condition
 
-    for key, value in update_data.items():
-        # Using ExpressionAttributeNames to avoid reserved words
-        placeholder_key = f"#{key}"
-        update_expression += f"{placeholder_key} = :{key}, "
-        expression_attribute_values[f":{key}"] = value
-        expression_attribute_names[placeholder_key] = key
+        # DynamoDB rejects a FilterExpression on the key attributes of the queried index
+        if index['hash'] in remaining_filters or range_key in remaining_filters:
+            continue
 
-    # Remove the trailing comma
-    update_expression = update_expression.rstrip(', ')
+        # A sort key condition narrows the read most, the table itself avoids eventually consistent GSIs
+        score = 1 + (2 if len(key_filters) > 1 else 0) + (1 if index['index'] is None else 0)
+        if score > best_score:
+            best = (index['index'], key_filters, remaining_filters)
+            best_score = score
 
-    return update_expression, expression_attribute_values, expression_attribute_names
+    return best
+
+
+class ParallelScan:
+    def __init__(self, table_name, region, filters=None, total_segments=4, max_workers=None, page_size=None,
+                 projection=None, lazy=False):
+
+        """
+        Scan a table in parallel over TotalSegments segments, each segment on its own low-level client.
+
+        :param table_name: Name of the DynamoDB table
+        :param region: Region of the table
+        :param filters: Filters in the format {attribute: {operator: value}} (optional)
+        :param total_segments: Number of segments the table is split into (optional, default = 4)
+        :param max_workers: Number of threads scanning segments at the same time (optional, default = total_segments)
+        :param page_size: Maximum number of items DynamoDB evaluates per request (optional)
+        :param projection: List of attribute names to return, e.g. ["id", "status"] (optional, default = all)
+        :param lazy: Return LazyItem objects that deserialize attributes on access (optional, default = False)
+        """
+
+        self.table_name = table_name
+        self.region = region
+        self.total_segments = total_segments
+        self.max_workers = max_workers or total_segments
+        self.page_size = page_size
+        self.filters = filters
+        self.projection = projection
+        self.lazy = lazy
+        self.stats = self._empty_stats()
+
+    def _empty_stats(self):
+        return [
+            {
+                'segment': segment,
+                'items': 0,
+                'scanned_count': 0,
+                'consumed_capacity': 0.0,
+                'seconds': 0.0,
+                'items_per_second': 0.0
+            }
+            for segment in range(self.total_segments)
+        ]
+
+    def _scan_kwargs(self):
+        scan_kwargs = {
+            'TableName': self.table_name,
+            'TotalSegments': self.total_segments,
+            'ReturnConsumedCapacity': 'TOTAL'
+        }
+        if self.page_size is not None:
+            scan_kwargs['Limit'] = self.page_size
+        names = {}
+        if self.filters:
+            filter_expression, filter_names, values = compile_filter_expression(self.filters)
+            scan_kwargs['FilterExpression'] = filter_expression
+            names.update(filter_names)
+            if values:
+                scan_kwargs['ExpressionAttributeValues'] = serialize_item(values)
+        if self.projection:
+            scan_kwargs['ProjectionExpression'], projection_names = compile_projection_expression(self.projection)
+            names.update(projection_names)
+        if names:
+            scan_kwargs['ExpressionAttributeNames'] = names
+        return scan_kwargs
+
+    def _segment_pages(self, segment, scan_kwargs):
+        import boto3
+
+        # A segment reads one page at a time, so one connection is enough; retries are those of the shared clients
+        client = clients.run_hooks(boto3.session.Session().client('dynamodb', region_name=self.region,
+                                                                  config=clients.client_config(1)))
+        decode = LazyItem if self.lazy else deserialize_item
+        stats = self.stats[segment]
+        scan_kwargs = dict(scan_kwargs, Segment=segment)
+        started = time.monotonic()
+
+        while True:
+            response = general.call_with_backoff(client.scan, **scan_kwargs)
+            items = [decode(item) for item in response['Items']]
+
+            stats['items'] += len(items)
+            stats['scanned_count'] += response.get('ScannedCount', 0)
+            stats['consumed_capacity'] += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0.0)
+            stats['seconds'] = time.monotonic() - started
+            if stats['seconds'] > 0:
+                stats['items_per_second'] = stats['items'] / stats['seconds']
+            yield items
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _streams(self, merged):
+        self.stats = self._empty_stats()
+        scan_kwargs = self._scan_kwargs()
+        producers = [
+            lambda segment=segment: self._segment_pages(segment, scan_kwargs)
+            for segment in range(self.total_segments)
+        ]
+        return general.stream_concurrently(producers, max_workers=self.max_workers, buffer_size=2, merged=merged)
+
+    def __iter__(self):
+        return self.items()
+
+    def items(self):
+
+        """
+        :return: generator yielding the items of all segments in the order they arrive
+        """
+
+        for page in self._streams(merged=True):
+            yield from page
+
+    def segments(self):
+
+        """
+        :return: list with one generator per segment. When max_workers is lower than total_segments the
+                 generators have to be consumed concurrently.
+        """
+
+        return [
+            (item for page in stream for item in page)
+            for stream in self._streams(merged=False)
+        ]
 
 
 class Connection:
-    def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb')
+    def __init__(self, mode='resource', lazy=False, region=None, max_pool_connections=None, item_cache=None):
 
+        """
+        :param mode: resource - use the boto3 resource layer (default).
+                     client - talk to the low-level client directly and (de)serialize values in this class,
+                     which skips the resource layer overhead on every request.
+        :param lazy: Only for mode client. Return LazyItem objects that deserialize an attribute the first time
+                     it is accessed, instead of deserializing every attribute up front (optional, default = False)
+        :param region: Region of the tables (optional, default = region of the environment)
+        :param max_pool_connections: HTTP connection pool size of the shared client, raise it when running
+                                     bulk operations with many workers (optional)
+        :param item_cache: LRUCache for items read by primary key, e.g. LRUCache(maxsize=10000, ttl=60) (optional).
+                           Key lookups through get, get_item and batch_get are served from it, writes through
+                           this connection update or invalidate it. Writes from elsewhere show after the ttl.
+        """
 
-    def get(self, table_name, filters=None):
-        table = self.dynamodb.Table(table_name)
+        if mode not in ('resource', 'client'):
+            raise ValueError(f"Unsupported mode: {mode}")
 
-        if filters is None:
-            response = table.scan()
-        else:
+        self.mode = mode
+        self.lazy = lazy and mode == 'client'
+        self.region = region
+        self.max_pool_connections = max_pool_connections
+        self.item_cache = item_cache
 
-            # Query with the dynamically built FilterExpression
-            response = table.scan(
-                FilterExpression=build_filter_expression(filters)
-            )
+    # The resource and client are created on first use, so constructing a Connection stays cheap
+    @functools.cached_property
+    def dynamodb(self):
+        if self.mode != 'resource':
+            return None
+        return clients.get_resource('dynamodb', self.region, self.max_pool_connections)
 
-        # Print the results
-        items = response['Items']
-        return items
+    @functools.cached_property
+    def client(self):
+        if self.mode == 'resource':
+            # The client of the resource is thread safe and (de)serializes values like the Table resource does
+            return self.dynamodb.meta.client
+        return clients.get_client('dynamodb', self.region, self.max_pool_connections)
 
+    def _key_names(self, table_name):
+        indexes = describe_key_schema(self.client, table_name)
+        if not indexes:
+            return None
+        return [name for name in (indexes[0]['hash'], indexes[0]['range']) if name is not None]
 
-    def update(self, table_name, filters, update_data, primarykey='id'):
-        table = self.dynamodb.Table(table_name)
-    # Step 1: Build FilterExpression dynamically based on the filters
+    @staticmethod
+    def _cache_key(table_name, key):
+        return table_name, tuple(sorted(key.items()))
 
-        # Step 2: Scan the table using the FilterExpression
-        response = table.scan(FilterExpression=build_filter_expression(filters))
-        items = response['Items']
+    def _cache_get(self, table_name, key):
+        if self.item_cache is None:
+            return None
+        item = self.item_cache.get(self._cache_key(table_name, key))
+        # LazyItem is read-only, plain items are copied so callers cannot change the cached one
+        return item if item is None or isinstance(item, LazyItem) else copy.deepcopy(item)
 
-        # Step 3: Build UpdateExpression dynamically based on the update data
-        update_expression, expression_attribute_values, expression_attribute_names = build_update_expression(update_data)
+    def _cache_put(self, table_name, item, key_names=None):
+        if self.item_cache is None:
+            return
+        key_names = key_names or self._key_names(table_name)
+        if not key_names or any(name not in item for name in key_names):
+            return
+        key = {name: item[name] for name in key_names}
+        self.item_cache.put(self._cache_key(table_name, key),
+                            item if isinstance(item, LazyItem) else copy.deepcopy(item))
+
+    def _cache_pop(self, table_name, key):
+        if self.item_cache is not None:
+            self.item_cache.pop(self._cache_key(table_name, key))
+
+    def _cache_drop_item(self, table_name, item):
+        if self.item_cache is None:
+            return
+        key_names = self._key_names(table_name)
+        if key_names and all(name in item for name in key_names):
+            self._cache_pop(table_name, {name: item[name] for name in key_names})
+
+    def _request(self, operation, max_retries=5, **kwargs):
+        call = getattr(self.client, operation)
+        if self.mode == 'resource':
+            return general.call_with_backoff(call, max_retries=max_retries, **kwargs)
+
+        for name in ('Key', 'Item', 'ExclusiveStartKey', 'ExpressionAttributeValues'):
+            if name in kwargs:
+                kwargs[name] = serialize_item(kwargs[name])
+        if 'RequestItems' in kwargs:
+            kwargs['RequestItems'] = _convert_request_items(kwargs['RequestItems'], serialize_item)
+
+        response = general.call_with_backoff(call, max_retries=max_retries, **kwargs)
+
+        decode = LazyItem if self.lazy else deserialize_item
+        if 'Items' in response:
+            response['Items'] = [decode(item) for item in response['Items']]
+        for name in ('Item', 'Attributes'):
+            if name in response:
+                response[name] = decode(response[name])
+        if 'Responses' in response:
+            response['Responses'] = {
+                table_name: [decode(item) for item in items] for table_name, items in response['Responses'].items()
+            }
+        # Keys are always decoded, so they can be passed back as exclusive_start_key or request items
+        if 'LastEvaluatedKey' in response:
+            response['LastEvaluatedKey'] = deserialize_item(response['LastEvaluatedKey'])
+        for name in ('UnprocessedKeys', 'UnprocessedItems'):
+            if response.get(name):
+                response[name] = _convert_request_items(response[name], deserialize_item)
+
+        return response
+
+    def iter_pages(self, table_name, filters=None, page_size=None, exclusive_start_key=None, use_index=True,
+                   projection=None):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param filters: Filters in the format {attribute: {operator: value}} (optional)
+        :param page_size: Maximum number of items DynamoDB evaluates per request (optional)
+        :param exclusive_start_key: LastEvaluatedKey of an earlier page to resume from (optional)
+        :param use_index: Query the table or one of its indexes when the filters contain an eq condition on
+                          its partition key, instead of scanning the whole table (optional, default = True)
+        :param projection: List of attribute names to return, e.g. ["id", "status"] (optional, default = all)
+        :return: generator yielding the raw scan or query response of every page. The LastEvaluatedKey of a page
+                 can be stored and passed back as exclusive_start_key to resume after that page.
+        """
+
+        operation = 'scan'
+        read_kwargs = {'TableName': table_name}
+        names = {}
+        values = {}
+
+        plan = None
+        if filters and use_index:
+            plan = plan_query(describe_key_schema(self.client, table_name), filters)
+        if plan is not None:
+            index_name, key_filters, filters = plan
+            operation = 'query'
+            key_condition_expression, key_names, key_values = compile_key_condition_expression(key_filters)
+            read_kwargs['KeyConditionExpression'] = key_condition_expression
+            names.update(key_names)
+            values.update(key_values)
+            if index_name is not None:
+                read_kwargs['IndexName'] = index_name
+
+        if filters:
+            filter_expression, filter_names, filter_values = compile_filter_expression(filters)
+            read_kwargs['FilterExpression'] = filter_expression
+            names.update(filter_names)
+            values.update(filter_values)
+        if projection:
+            read_kwargs['ProjectionExpression'], projection_names = compile_projection_expression(projection)
+            names.update(projection_names)
+        if names:
+            read_kwargs['ExpressionAttributeNames'] = names
+        if values:
+            read_kwargs['ExpressionAttributeValues'] = values
+        if page_size is not None:
+            read_kwargs['Limit'] = page_size
+
+        while True:
+            if exclusive_start_key is not None:
+                read_kwargs['ExclusiveStartKey'] = exclusive_start_key
+            response = self._request(operation, **read_kwargs)
+            yield response
+
+            exclusive_start_key = response.get('LastEvaluatedKey')
+            if exclusive_start_key is None:
+                break
+
+    def iter_items(self, table_name, filters=None, page_size=None, limit=None, exclusive_start_key=None,
+                   use_index=True, projection=None):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param filters: Filters in the format {attribute: {operator: value}} (optional)
+        :param page_size: Maximum number of items DynamoDB evaluates per request (optional)
+        :param limit: Maximum number of items to yield in total (optional)
+        :param exclusive_start_key: LastEvaluatedKey of an earlier page to resume from (optional)
+        :param use_index: Query instead of scan when the filters allow it, see iter_pages (optional, default = True)
+        :param projection: List of attribute names to return, e.g. ["id", "status"] (optional, default = all)
+        :return: generator yielding the matching items one by one, holding at most one page in memory
+        """
+
+        if limit is not None and limit <= 0:
+            return
+
+        count = 0
+        for page in self.iter_pages(table_name, filters=filters, page_size=page_size,
+                                    exclusive_start_key=exclusive_start_key, use_index=use_index,
+                                    projection=projection):
+            for item in page['Items']:
+                yield item
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    def parallel_scan(self, table_name, filters=None, total_segments=4, max_workers=None, page_size=None,
+                      projection=None):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param filters: Filters in the format {attribute: {operator: value}} (optional)
+        :param total_segments: Number of segments the table is split into (optional, default = 4)
+        :param max_workers: Number of threads scanning segments at the same time (optional, default = total_segments)
+        :param page_size: Maximum number of items DynamoDB evaluates per request (optional)
+        :param projection: List of attribute names to return, e.g. ["id", "status"] (optional, default = all)
+        :return: ParallelScan - iterate it for one merged stream of items, or call segments() for one stream
+                 per segment. Its stats attribute holds items/sec and consumed capacity for each segment.
+        """
+
+        return ParallelScan(
+            table_name,
+            self.client.meta.region_name,
+            filters=filters,
+            total_segments=total_segments,
+            max_workers=max_workers,
+            page_size=page_size,
+            projection=projection,
+            lazy=self.lazy
+        )
+
+    def get(self, table_name, filters=None, limit=None, projection=None):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param filters: Filters in the format {attribute: {operator: value}} (optional)
+        :param limit: Maximum number of items to return (optional)
+        :param projection: List of attribute names to return, e.g. ["id", "status"] (optional, default = all)
+        :return: list with all matching items of the table, following every page of the scan. Filters that are
+                 eq conditions on exactly the primary key are served by get_item (and the item cache) instead.
+        """
 
-        # Step 4: Update each item that matches the filter
-        updated_items = {}
+        key = self._lookup_key(table_name, filters)
+        if key is not None:
+            item = self.get_item(table_name, key, projection=projection)
+            return [] if item is None or (limit is not None and limit <= 0) else [item]
+        return list(self.iter_items(table_name, filters=filters, limit=limit, projection=projection))
 
-        for item in items:
+    def _lookup_key(self, table_name, filters):
+        if not filters or any(list(condition) != ['eq'] for condition in filters.values()):
+            return None
+        key_names = self._key_names(table_name)
+        if not key_names or sorted(key_names) != sorted(filters):
+            return None
+        return {name: condition['eq'] for name, condition in filters.items()}
 
-            try:
-                update = {}
-                update_response = table.update_item(
-                    Key={primarykey: item[primarykey]},  # Assuming 'primaryKey' is your primary key
-                    UpdateExpression=update_expression,
-                    ExpressionAttributeNames=expression_attribute_names,
-                    ExpressionAttributeValues=expression_attribute_values,
-                    ReturnValues="UPDATED_NEW"
-                )
-                for key_name, key_value in zip(expression_attribute_names.values(), expression_attribute_values.values()):
-                    update[key_name] = key_value
+    def get_item(self, table_name, key, projection=None, consistent_read=False):
 
-                updated_items[item[primarykey]] = update
+        """
+        :param table_name: Name of the DynamoDB table
+        :param key: Primary key of the item, e.g. {"id": "abc"}
+        :param projection: List of attribute names to return (optional, default = all). Projected reads bypass
+                           the item cache.
+        :param consistent_read: Use a strongly consistent read, which bypasses the item cache (optional)
+        :return: the item, or None when it does not exist
+        """
 
+        cacheable = self.item_cache is not None and not projection and not consistent_read
+        if cacheable:
+            item = self._cache_get(table_name, key)
+            if item is not None:
+                return item
 
-            except:
+        get_kwargs = {'TableName': table_name, 'Key': key}
+        if projection:
+            get_kwargs['ProjectionExpression'], get_kwargs['ExpressionAttributeNames'] = \
+                compile_projection_expression(projection)
+        if consistent_read:
+            get_kwargs['ConsistentRead'] = True
+
+        item = self._request('get_item', **get_kwargs).get('Item')
+        if item is not None and not projection:
+            self._cache_put(table_name, item, list(key))
+        return item
+
+    def put(self, table_name, item):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param item: Item to write, replaces the item with the same primary key
+        :return: the put_item response
+        """
+
+        try:
+            return self._request('put_item', TableName=table_name, Item=item)
+        finally:
+            # Invalidate rather than write through, so the next get returns the item as DynamoDB reads it
+            self._cache_drop_item(table_name, item)
+
+    def delete(self, table_name, key):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param key: Primary key of the item to delete, e.g. {"id": "abc"}
+        :return: the delete_item response
+        """
+
+        try:
+            return self._request('delete_item', TableName=table_name, Key=key)
+        finally:
+            self._cache_pop(table_name, key)
+
+    def _batch_request(self, operation, table_name, requests, table_request, max_retries):
+        # Resend what DynamoDB left unprocessed with jittered backoff. Returns (items read, requests left over)
+        items = []
+        attempt = 0
+        while True:
+            if operation == 'batch_get_item':
+                request_items = {table_name: dict(table_request, Keys=requests)}
+            else:
+                request_items = {table_name: requests}
+            response = self._request(operation, max_retries=max_retries, RequestItems=request_items)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+
+            unprocessed = response.get('UnprocessedKeys', response.get('UnprocessedItems', {})).get(table_name)
+            if operation == 'batch_get_item':
+                requests = unprocessed['Keys'] if unprocessed else []
+            else:
+                requests = unprocessed or []
+            if not requests or attempt >= max_retries:
+                return items, requests
+            time.sleep(general.backoff_delay(attempt))
+            attempt += 1
+
+    def batch_get(self, table_name, keys, projection=None, consistent_read=False, max_workers=8, max_retries=8):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param keys: Iterable of primary keys, e.g. [{"id": "a"}, {"id": "b"}], may be a generator
+        :param projection: List of attribute names to return, e.g. ["id", "status"] (optional, default = all)
+        :param consistent_read: Use strongly consistent reads (optional, default = False)
+        :param max_workers: Number of batch_get_item requests of 100 keys in flight (optional, default = 8)
+        :param max_retries: Retries of unprocessed keys and throttled requests with jittered backoff (optional, default = 8)
+        :return: generator yielding the items that exist, in no particular order. Keys are read ahead in batches,
+                 so memory stays bounded whatever the number of keys. Raises the error of a batch that failed.
+        """
+
+        table_request = {}
+        if projection:
+            table_request['ProjectionExpression'], table_request['ExpressionAttributeNames'] = \
+                compile_projection_expression(projection)
+        if consistent_read:
+            table_request['ConsistentRead'] = True
+
+        cacheable = self.item_cache is not None and not projection and not consistent_read
+
+        def get_batch(batch):
+            cached = []
+            if cacheable:
+                missing = []
+                for key in batch:
+                    item = self._cache_get(table_name, key)
+                    if item is None:
+                        missing.append(key)
+                    else:
+                        cached.append(item)
+                batch = missing
+            # DynamoDB rejects a request that holds the same key twice
+            unique = list({tuple(sorted(key.items())): key for key in batch}.values())
+            if not unique:
+                return cached, []
+            items, unprocessed = self._batch_request('batch_get_item', table_name, unique, table_request, max_retries)
+            if cacheable:
+                for item in items:
+                    self._cache_put(table_name, item, list(unique[0]))
+            return cached + items, unprocessed
+
+        for _, outcome, error in general.map_concurrently(get_batch, _chunks(keys, BATCH_GET_SIZE),
+                                                          max_workers=max_workers):
+            if error is not None:
+                raise error
+            items, unprocessed = outcome
+            if unprocessed:
+                raise RuntimeError(f"{len(unprocessed)} keys of {table_name} were still unprocessed after "
+                                   f"{max_retries} retries")
+            yield from items
+
+    def _batch_write(self, table_name, values, request_type, field, max_workers, max_retries):
+        key_names = self._key_names(table_name)
+
+        def write_batch(batch):
+            requests = [{request_type: {field: value}} for value in batch]
+            if key_names:
+                # DynamoDB rejects a request that writes the same key twice, the last write wins
+                requests = list({
+                    tuple(request[request_type][field].get(name) for name in key_names): request
+                    for request in requests
+                }.values())
+            return self._batch_request('batch_write_item', table_name, requests, None, max_retries)
+
+        result = {'succeeded': 0, 'failed': []}
+        name = field.lower()
+        for batch, outcome, error in general.map_concurrently(write_batch, _chunks(values, BATCH_WRITE_SIZE),
+                                                              max_workers=max_workers):
+            if self.item_cache is not None:
+                # Invalidate rather than write through, a failed or unprocessed put leaves the old item in place
+                for value in batch:
+                    key = value if field == 'Key' else {key_name: value.get(key_name) for key_name in key_names or []}
+                    if key:
+                        self._cache_pop(table_name, key)
+            if error is not None:
+                result['failed'].extend({name: value, 'error': error} for value in batch)
                 continue
+            unprocessed = outcome[1]
+            if unprocessed:
+                error = RuntimeError(f"Still unprocessed after {max_retries} retries")
+                result['failed'].extend({name: request[request_type][field], 'error': error} for request in unprocessed)
+            result['succeeded'] += len(batch) - len(unprocessed)
+
+        return result
+
+    def batch_put(self, table_name, items, max_workers=8, max_retries=8):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param items: Iterable of items to write, may be a generator. Items with the same key in one batch of 25
+                      are written once, the last one wins.
+        :param max_workers: Number of batch_write_item requests of 25 items in flight (optional, default = 8)
+        :param max_retries: Retries of unprocessed items and throttled requests with jittered backoff (optional, default = 8)
+        :return: {"succeeded": number of written items, "failed": [{"item": item, "error": error}]}
+        """
+
+        return self._batch_write(table_name, items, 'PutRequest', 'Item', max_workers, max_retries)
+
+    def batch_delete(self, table_name, keys, max_workers=8, max_retries=8):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param keys: Iterable of primary keys to delete, e.g. [{"id": "a"}], may be a generator
+        :param max_workers: Number of batch_write_item requests of 25 keys in flight (optional, default = 8)
+        :param max_retries: Retries of unprocessed keys and throttled requests with jittered backoff (optional, default = 8)
+        :return: {"succeeded": number of deleted keys, "failed": [{"key": key, "error": error}]}
+        """
+
+        return self._batch_write(table_name, keys, 'DeleteRequest', 'Key', max_workers, max_retries)
+
+    def bulk_update(self, table_name, filters, update_data, primarykey='id', max_workers=16, max_retries=5,
+                    keys=None):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param filters: Filters in the format {attribute: {operator: value}} selecting the items to update. They are
+                        also sent as the ConditionExpression of every update_item, so an item that changed in
+                        between is not updated (optional with keys)
+        :param update_data: Attributes to set on every matching item, e.g. {"status": "done"}
+        :param primarykey: Name of the partition key, only used when the table cannot be described (optional,
+                           default = id). The key schema of the table, including a sort key, is used otherwise.
+        :param max_workers: Number of update_item calls running at the same time (optional, default = 16)
+        :param max_retries: Retries of a throttled update_item call with jittered backoff (optional, default = 5)
+        :param keys: Iterable of the keys (or items) to update, e.g. [{"pk": "a", "sk": 1}], or of partition key
+                     values for a table without sort key (optional). Skips the scan: only these items are updated,
+                     when they exist and match filters. Either filters or keys is required.
+        :return: {"succeeded": {key: updated attributes}, "failed": {key: error}, "not_matched": [key]}. A key is
+                 the partition key value, or a tuple of the partition and sort key values for a composite key.
+                 not_matched holds the keys that do not exist or no longer match filters.
+        """
+
+        if not filters and keys is None:
+            raise ValueError('bulk_update needs filters or keys, it does not update every item of a table')
+
+        key_names = self._key_names(table_name) or [primarykey]
+        update_expression, expression_attribute_values, expression_attribute_names = build_update_expression(update_data)
+        update = dict(zip(expression_attribute_names.values(), expression_attribute_values.values()))
+
+        # update_item creates missing items, the condition on the partition key restricts it to existing ones
+        conditions = dict(filters or {})
+        conditions[key_names[0]] = dict(conditions.get(key_names[0], {}), attribute_exists=True)
+        condition_expression, condition_names, condition_values = compile_filter_expression(conditions, prefix='c')
+        expression_attribute_names.update(condition_names)
+        expression_attribute_values.update(condition_values)
+
+        def update_item(key):
+            return self._request(
+                'update_item',
+                max_retries=max_retries,
+                TableName=table_name,
+                Key=key,
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames=expression_attribute_names,
+                ExpressionAttributeValues=expression_attribute_values,
+                ReturnValues='UPDATED_NEW'
+            )
+
+        def as_key(key):
+            if isinstance(key, collections.abc.Mapping):
+                # Full items may be passed as keys, only the key attributes are sent
+                return {name: key[name] for name in key_names}
+            return {key_names[0]: key}
+
+        def result_key(key):
+            values = tuple(key.get(name) for name in key_names)
+            return values[0] if len(values) == 1 else values
+
+        if keys is None:
+            keys = self.iter_items(table_name, filters=filters, projection=key_names)
+
+        result = {'succeeded': {}, 'failed': {}, 'not_matched': []}
+        for key, _, error in general.map_concurrently(update_item, (as_key(key) for key in keys),
+                                                      max_workers=max_workers):
+            self._cache_pop(table_name, key)
+            if error is None:
+                result['succeeded'][result_key(key)] = dict(update)
+            elif general.error_code(error) == 'ConditionalCheckFailedException':
+                result['not_matched'].append(result_key(key))
+            else:
+                result['failed'][result_key(key)] = error
+
+        return result
+
+    def update(self, table_name, filters, update_data, primarykey='id', keys=None):
+
+        """
+        :param table_name: Name of the DynamoDB table
+        :param filters: Filters in the format {attribute: {operator: value}} selecting the items to update
+        :param update_data: Attributes to set on every matching item, e.g. {"status": "done"}
+        :param primarykey: Name of the partition key when the table cannot be described (optional, default = id)
+        :param keys: Keys of the items to update instead of scanning for them, see bulk_update (optional)
+        :return: {key: updated attributes} for every item that was updated. Use bulk_update to get the failures too.
+        """
 
-        return updated_items
+        return self.bulk_update(table_name, filters, update_data, primarykey=primarykey, keys=keys)['succeeded']
@@ -1,20 +1,368 @@
-import boto3
-from botocore.exceptions import ClientError
+import collections
+import queue
+import random
+import threading
+import time
+from aws_utils import metrics
+
+_DONE = object()
+
+THROTTLING_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException'
+}
+
+# Server side failures that usually succeed when the call is repeated
+TRANSIENT_ERROR_CODES = {
+    'ConnectTimeoutError',
+    'ConnectionClosedError',
+    'EndpointConnectionError',
+    'InternalError',
+    'InternalFailure',
+    'InternalServerError',
+    'ReadTimeoutError',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'ServiceUnavailable',
+    'ServiceUnavailableException'
+}
+
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | TRANSIENT_ERROR_CODES
+
+# Calls per second of the client side rate limiter of a service, per region. The limiters adapt to throttling,
+# so these only cap the rate; change them before the first call to apply a different limit. Only services with
+# a low, account wide limit are listed: a limiter of a whole region would let one hot table or prefix slow down
+# every other call. Other services are not rate limited unless default_rate is set.
+SERVICE_RATES = {
+    'iam': 20,
+    'sts': 100
+}
+default_rate = None
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def error_code(error):
+
+    """
+    :param error: Exception raised by a botocore client
+    :return: the AWS error code of a ClientError, the class name of a botocore connection error, otherwise None
+    """
+
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and 'Error' in response:
+        return response['Error'].get('Code')
+    if type(error).__module__.startswith('botocore'):
+        return type(error).__name__
+    return None
+
+
+def rate_limiter(service, region=None):
+
+    """
+    :param service: Name of the AWS service, e.g. iam
+    :param region: Region of the client (optional)
+    :return: the RateLimiter shared by every call to service in region, or None when the service has no rate
+    """
+
+    key = (service, region)
+    if key not in _limiters:
+        with _limiters_lock:
+            if key not in _limiters:
+                rate = SERVICE_RATES.get(service, default_rate)
+                _limiters[key] = RateLimiter(rate) if rate else None
+    return _limiters[key]
+
+
+def _client_rate_limiter(func):
+    meta = getattr(getattr(func, '__self__', None), 'meta', None)
+    service_model = getattr(meta, 'service_model', None)
+    if service_model is None:
+        return None
+    return rate_limiter(service_model.service_name, meta.region_name)
+
+
+def handle_action(action, *args, **kwargs):
+
+    """
+    Central execution of the wrapper calls. action is called with args and kwargs through call_with_backoff, so
+    throttling and transient errors are retried with jittered backoff under the rate limiter of the service.
+    For backwards compatibility action may also be an already evaluated response.
+
+    :param action: Client method, e.g. client.get_role, or a response
+    :return: if successfull - Returns status_code = HTTP status code with content = response information.
+             Otherwise - status_code = 500 with content = Error information
+    """
 
-def handle_action(action):
     return_response = {
         'status_code': '',
         'content': ''
     }
     try:
-        response = action
+        response = call_with_backoff(action, *args, **kwargs) if callable(action) else action
         return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
         return_response['content'] = response
-    except ClientError as e:
-        return_response['status_code'] = 500
-        return_response['content'] = e
     except Exception as e:
         return_response['status_code'] = 500
         return_response['content'] = e
 
     return return_response
+
+
+def stream_concurrently(producers, max_workers=None, buffer_size=16, merged=True):
+
+    """
+    Run producers on a thread pool and stream their results back to the caller.
+
+    :param producers: list of callables that each return an iterable
+    :param max_workers: Size of the thread pool (optional, default = one thread per producer)
+    :param buffer_size: Maximum number of results buffered per stream before producers wait (optional)
+    :param merged: True - return one generator with the results of all producers in arrival order.
+                   False - return a list with one generator per producer
+    :return: generator or list of generators, see merged. An exception raised by a producer is re-raised
+             by the generator that streams its results. With merged=False and fewer workers than producers
+             the generators have to be consumed concurrently. The producers of a generator start when it is
+             first iterated and stop when it is closed; they run on daemon threads, so an abandoned generator
+             does not keep the interpreter from exiting.
+    """
+
+    producers = list(producers)
+    stream_count = 1 if merged else len(producers)
+    queues = [queue.Queue(maxsize=buffer_size) for _ in range(stream_count)]
+    stops = [threading.Event() for _ in range(stream_count)]
+
+    def put(index, entry):
+        while not stops[index].is_set():
+            try:
+                queues[index].put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    workers = threading.Semaphore(max_workers or max(len(producers), 1))
+
+    def run(producer, index):
+        with workers:
+            if stops[index].is_set():
+                return
+            try:
+                for result in producer():
+                    if not put(index, (True, result)):
+                        return
+            except Exception as e:
+                put(index, (False, e))
+                return
+            put(index, (False, _DONE))
+
+    def consume(index, expected):
+        for position, producer in enumerate(producers):
+            if merged or position == index:
+                threading.Thread(target=run, args=(producer, index), daemon=True,
+                                 name=f"aws_utils-stream-{index}-{position}").start()
+        finished = 0
+        try:
+            while finished < expected:
+                ok, value = queues[index].get()
+                if ok:
+                    yield value
+                elif value is _DONE:
+                    finished += 1
+                else:
+                    raise value
+        finally:
+            stops[index].set()
+
+    if merged:
+        return consume(0, len(producers))
+    return [consume(index, 1) for index in range(stream_count)]
+
+
+def backoff_delay(attempt, base_delay=0.05, max_delay=5.0):
+
+    """
+    :param attempt: Number of the retry, starting at 0
+    :param base_delay: Delay in seconds of the first retry before jitter (optional, default = 0.05)
+    :param max_delay: Upper bound in seconds of a single delay (optional, default = 5.0)
+    :return: full-jitter exponential backoff delay in seconds
+    """
+
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def _record_retry(func, kwargs):
+    meta = getattr(getattr(func, '__self__', None), 'meta', None)
+    if getattr(meta, 'service_model', None) is None:
+        metrics.registry.record_retry('unknown', getattr(func, '__name__', 'unknown'))
+        return
+    operation = meta.method_to_api_mapping.get(func.__name__, func.__name__)
+    metrics.registry.record_retry(meta.service_model.service_name, operation, metrics.resource_of(kwargs))
+
+
+def call_with_backoff(func, *args, retry_codes=RETRYABLE_ERROR_CODES, max_retries=5, base_delay=0.05,
+                      max_delay=5.0, limiter=None, **kwargs):
+
+    """
+    Call func(*args, **kwargs) and retry it with full-jitter exponential backoff while it raises an error
+    whose error code is in retry_codes. Every attempt first acquires a token of the rate limiter, throttling
+    errors lower its rate.
+
+    :param func: Callable to execute, e.g. client.update_item
+    :param retry_codes: Error codes that are retried (optional, default = throttling and transient errors)
+    :param max_retries: Maximum number of retries before the error is raised (optional, default = 5)
+    :param base_delay: Delay in seconds of the first retry before jitter (optional, default = 0.05)
+    :param max_delay: Upper bound in seconds of a single delay (optional, default = 5.0)
+    :param limiter: RateLimiter of the call (optional, default = the limiter of the service when func is a client
+                    method). Pass False to call without a limiter.
+    :return: the return value of func
+    """
+
+    if limiter is None:
+        limiter = _client_rate_limiter(func)
+
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            code = error_code(e)
+            if limiter and code in THROTTLING_ERROR_CODES:
+                limiter.throttled()
+            if attempt >= max_retries or code not in retry_codes:
+                raise
+        else:
+            if limiter:
+                limiter.succeeded()
+            return result
+        if metrics.enabled:
+            _record_retry(func, kwargs)
+        time.sleep(backoff_delay(attempt, base_delay, max_delay))
+        attempt += 1
+
+
+def iter_pages(func, input_token='Marker', output_token='NextMarker', **kwargs):
+
+    """
+    Follow the pages of a list call, every page through call_with_backoff.
+
+    :param func: Client method, e.g. client.list_functions
+    :param input_token: Parameter that passes the token of the next page (optional, default = Marker)
+    :param output_token: Field of a page with the token of the next page (optional, default = NextMarker)
+    :return: generator yielding the pages
+    """
+
+    while True:
+        page = call_with_backoff(func, **kwargs)
+        yield page
+        token = page.get(output_token)
+        if not token:
+            return
+        kwargs[input_token] = token
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None, min_rate=1.0, increase=0.5):
+
+        """
+        Thread safe token bucket with additive-increase / multiplicative-decrease of its rate: every
+        throttling error halves the rate, every success raises it again towards the configured rate.
+
+        :param rate: Maximum number of calls per second
+        :param burst: Number of calls that may start at once (optional, default = rate)
+        :param min_rate: Lower bound of the adapted rate (optional, default = 1.0)
+        :param increase: Calls per second added after each success (optional, default = 0.5)
+        """
+
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.increase = increase
+        self.tokens = self.burst
+        self.throttles = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+
+        """
+        Block until a call may start.
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Drop the saved up burst as well, otherwise the next calls are throttled right away
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+def map_concurrently(func, items, max_workers=16, ordered=False):
+
+    """
+    Apply func to every item on a bounded thread pool. Items are pulled from the iterable lazily, so at
+    most 2 * max_workers calls are pending at any time.
+
+    :param func: Callable taking a single item
+    :param items: Iterable of items, may be a generator
+    :param max_workers: Size of the thread pool (optional, default = 16)
+    :param ordered: True - yield results in input order. False - yield them as they complete (optional)
+    :return: generator yielding (item, result, error) tuples, where error is the raised exception or None
+    """
+
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    iterator = iter(items)
+    in_flight = {}
+    order = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def fill():
+        while len(in_flight) < max_workers * 2:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            future = executor.submit(func, item)
+            in_flight[future] = item
+            if ordered:
+                order.append(future)
+
+    try:
+        fill()
+        while in_flight:
+            if ordered:
+                done = [order.popleft()]
+                wait(done)
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                item = in_flight.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+            fill()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -1,9 +1,48 @@
-import boto3
+import copy
 import json
-from botocore.exceptions import ClientError
+from urllib.parse import unquote
+from aws_utils import cache, clients, general
+
+
+def _trust_document(services):
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": services
+                },
+                "Action": "sts:AssumeRole"
+            }
+        ]
+    }
+
+
+def _policy_document(permissions):
+    return {
+        "Version": "2012-10-17",
+        "Statement": permissions
+    }
+
+
+def _normalize_document(document):
+    # IAM returns single element lists as scalars and does not keep the order of lists
+    if isinstance(document, str) and document.startswith('%7B'):
+        document = json.loads(unquote(document))
+    if isinstance(document, dict):
+        return {key: _normalize_document(value) for key, value in document.items()}
+    if isinstance(document, list):
+        values = [_normalize_document(value) for value in document]
+        if len(values) == 1:
+            return values[0]
+        return sorted(values, key=lambda value: json.dumps(value, sort_keys=True))
+    return document
 
 
 class Role:
+    iam = clients.LazyClient('iam')
+
     def __init__(self, region, aws_id):
 
         """
@@ -13,35 +52,27 @@ class Role:
 
         self.region = region
         self.aws_id = aws_id
-        self.iam = boto3.client('iam', region_name=region)
 
-    def get(self, name):
+    def get(self, name, use_cache=True):
 
         """
         :param name: Role name
+        :param use_cache: Serve the role from the shared metadata cache when present (optional, default = True)
         :return: if successfull - Returns status_code = 200 with content = response information.
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
+        cache_key = ('iam', 'role', name)
+        cached = cache.metadata_cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            return {'status_code': 200, 'content': copy.deepcopy(cached)}
 
-        try:
-
-            response = self.iam.get_role(
-                RoleName=name
-            )
-
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
+        return_response = general.handle_action(
+            self.iam.get_role,
+            RoleName=name
+        )
+        if return_response['status_code'] == 200:
+            cache.metadata_cache.put(cache_key, copy.deepcopy(return_response['content']))
 
         return return_response
 
@@ -55,38 +86,15 @@ class Role:
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
-        try:
-            document = {
-                "Version": "2012-10-17",
-                "Statement": [
-                    {
-                        "Effect": "Allow",
-                        "Principal": {
-                            "Service": services
-                        },
-                        "Action": "sts:AssumeRole"
-                    }
-                ]
-            }
-            response = self.iam.create_role(
-                RoleName=name,
-                AssumeRolePolicyDocument=json.dumps(document),
-                Description=description
-            )
-
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
+        document = _trust_document(services)
+        return_response = general.handle_action(
+            self.iam.create_role,
+            RoleName=name,
+            AssumeRolePolicyDocument=json.dumps(document),
+            Description=description
+        )
 
+        cache.metadata_cache.pop(('iam', 'role', name))
         return return_response
 
     def attach_policy(self, role_name, policy_arn):
@@ -97,24 +105,14 @@ class Role:
         :return: if successfull - Returns status_code = 200 with content = response information.
                  Otherwise - status_code = 500 with content = Error information
         """
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
-        try:
-            response = self.iam.attach_role_policy(
-                RoleName=role_name,
-                PolicyArn=policy_arn
-            )
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-
+        return_response = general.handle_action(
+            self.iam.attach_role_policy,
+            RoleName=role_name,
+            PolicyArn=policy_arn
+        )
+
+        cache.metadata_cache.pop(('iam', 'role', role_name))
+        cache.metadata_cache.pop(('iam', 'policy', policy_arn))
         return return_response
 
     def detach_policy(self, role_name, policy_arn):
@@ -125,24 +123,14 @@ class Role:
         :return: if successfull - Returns status_code = 200 with content = response information.
                  Otherwise - status_code = 500 with content = Error information
         """
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
-        try:
-            response = self.iam.detach_role_policy(
-                RoleName=role_name,
-                PolicyArn=policy_arn
-            )
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-
+        return_response = general.handle_action(
+            self.iam.detach_role_policy,
+            RoleName=role_name,
+            PolicyArn=policy_arn
+        )
+
+        cache.metadata_cache.pop(('iam', 'role', role_name))
+        cache.metadata_cache.pop(('iam', 'policy', policy_arn))
         return return_response
 
     def delete(self, name):
@@ -153,62 +141,60 @@ class Role:
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
+        return_response = general.handle_action(
+            self.iam.delete_role,
+            RoleName=name
+        )
+
+        cache.metadata_cache.pop(('iam', 'role', name))
+        return return_response
 
-        try:
+    def warm_cache(self):
 
-            response = self.iam.delete_role(
-                RoleName=name
-            )
+        """
+        Prefetch every role of the account into the shared metadata cache with paginated list_roles calls.
+        Roles from a listing lack RoleLastUsed, Tags and PermissionsBoundary; call get with use_cache=False
+        when you need those.
 
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
+        :return: number of cached roles
+        """
 
-        return return_response
+        count = 0
+        for page in general.iter_pages(self.iam.list_roles, output_token='Marker'):
+            for role in page['Roles']:
+                response = {'Role': role, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+                cache.metadata_cache.put(('iam', 'role', role['RoleName']), response)
+                count += 1
+        return count
 
 
 class Policy:
+    iam = clients.LazyClient('iam')
+
     def __init__(self, region, aws_id):
         self.region = region
         self.aws_id = aws_id
-        self.iam = boto3.client('iam', region_name=region)
 
-    def get(self, arn):
+    def get(self, arn, use_cache=True):
 
         """
         :param arn: Policy Arn
+        :param use_cache: Serve the policy from the shared metadata cache when present (optional, default = True)
         :return: if successfull - Returns status_code = 200 with content = response information
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
-
-        try:
-
-            response = self.iam.get_policy(
-                PolicyArn=arn
-            )
+        cache_key = ('iam', 'policy', arn)
+        cached = cache.metadata_cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            return {'status_code': 200, 'content': copy.deepcopy(cached)}
 
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
+        return_response = general.handle_action(
+            self.iam.get_policy,
+            PolicyArn=arn
+        )
+        if return_response['status_code'] == 200:
+            cache.metadata_cache.put(cache_key, copy.deepcopy(return_response['content']))
 
         return return_response
 
@@ -234,31 +220,15 @@ class Policy:
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
-
-        try:
-            document = {
-                "Version": "2012-10-17",
-                "Statement": permissions
-            }
-            response = self.iam.create_policy(
-                PolicyName=name,
-                Description=description,
-                PolicyDocument=json.dumps(document)
-            )
-
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
+        document = _policy_document(permissions)
+        return_response = general.handle_action(
+            self.iam.create_policy,
+            PolicyName=name,
+            Description=description,
+            PolicyDocument=json.dumps(document)
+        )
 
+        cache.metadata_cache.pop(('iam', 'policy', f"arn:aws:iam::{self.aws_id}:policy/{name}"))
         return return_response
 
     def delete(self, arn):
@@ -269,24 +239,264 @@ class Policy:
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return_response = {
-            'status_code': '',
-            'content': ''
-        }
+        return_response = general.handle_action(
+            self.iam.delete_policy,
+            PolicyArn=arn
+        )
+
+        cache.metadata_cache.pop(('iam', 'policy', arn))
+        return return_response
+
+    def warm_cache(self, scope='Local'):
+
+        """
+        Prefetch policies into the shared metadata cache with paginated list_policies calls.
+
+        :param scope: Local (customer managed, default), AWS or All
+        :return: number of cached policies
+        """
+
+        count = 0
+        for page in general.iter_pages(self.iam.list_policies, output_token='Marker', Scope=scope):
+            for policy in page['Policies']:
+                response = {'Policy': policy, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+                cache.metadata_cache.put(('iam', 'policy', policy['Arn']), response)
+                count += 1
+        return count
+
+
+class Provisioner:
+    iam = clients.LazyClient('iam')
+
+    def __init__(self, region, aws_id, max_workers=8, rate=None, max_retries=8):
 
-        try:
+        """
+        Declarative bulk provisioning of roles, policies and their attachments. The current state is read with a
+        few paginated list calls and only the differences are applied, so applying the same spec twice is a no-op
+        and a failed run can simply be repeated.
+
+        :param region: Preferred region, e.g. eu-central-1
+        :param aws_id: AWS Account ID
+        :param max_workers: Number of concurrent IAM calls (optional, default = 8)
+        :param rate: Maximum number of IAM calls per second, lowered automatically while IAM throttles
+                     (optional, default = the shared IAM rate limiter of general)
+        :param max_retries: Retries of a throttled call before the operation fails (optional, default = 8)
+        """
+
+        self.region = region
+        self.aws_id = aws_id
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.limiter = general.RateLimiter(rate) if rate else None
+
+    def _call(self, operation, retry_codes=general.RETRYABLE_ERROR_CODES, **kwargs):
+        return general.call_with_backoff(
+            getattr(self.iam, operation), retry_codes=retry_codes, max_retries=self.max_retries,
+            base_delay=0.2, limiter=self.limiter, **kwargs
+        )
+
+    def _paginate(self, operation, key, **kwargs):
+        marker = None
+        while True:
+            if marker:
+                kwargs['Marker'] = marker
+            page = self._call(operation, **kwargs)
+            yield from page[key]
+            if not page.get('IsTruncated'):
+                return
+            marker = page['Marker']
+
+    def _policy_arn(self, policy, policies):
+        if policy.startswith('arn:'):
+            return policy
+        if policy in policies:
+            return policies[policy]['Arn']
+        return f"arn:aws:iam::{self.aws_id}:policy/{policy}"
+
+    def plan(self, spec, prune=False):
+
+        """
+        :param spec: Desired state, e.g.
+        {
+            "policies": [{"name": "my-policy", "permissions": [...], "description": ""}],
+            "roles": [{"name": "my-role", "services": ["lambda.amazonaws.com"], "description": ""}],
+            "attachments": [{"role": "my-role", "policy": "my-policy"}]
+        }
+        policy of an attachment is the name of a customer managed policy or the arn of any policy
+        :param prune: Also detach policies of the roles in the spec that are not in its attachments (optional, default = False)
+        :return: list of operations, every operation is a dict with an "action" and the arguments of the IAM call
+        """
 
-            response = self.iam.delete_policy(
-                PolicyArn=arn
+        roles = {role['RoleName']: role for role in self._paginate('list_roles', 'Roles')}
+        policies = {policy['PolicyName']: policy for policy in
+                    self._paginate('list_policies', 'Policies', Scope='Local')}
+
+        def read_document(policy):
+            version = self._call('get_policy_version', PolicyArn=policy['Arn'], VersionId=policy['DefaultVersionId'])
+            return version['PolicyVersion']['Document']
+
+        def read_attachments(role_name):
+            return {policy['PolicyArn'] for policy in
+                    self._paginate('list_attached_role_policies', 'AttachedPolicies', RoleName=role_name)}
+
+        existing_policies = [policies[policy['name']] for policy in spec.get('policies', [])
+                             if policy['name'] in policies]
+        documents = {}
+        for policy, document, error in general.map_concurrently(read_document, existing_policies, self.max_workers):
+            if error is not None:
+                raise error
+            documents[policy['PolicyName']] = document
+
+        existing_roles = [role['name'] for role in spec.get('roles', []) if role['name'] in roles]
+        attached = {}
+        for role_name, arns, error in general.map_concurrently(read_attachments, existing_roles, self.max_workers):
+            if error is not None:
+                raise error
+            attached[role_name] = arns
+
+        operations = []
+        for policy in spec.get('policies', []):
+            document = _policy_document(policy['permissions'])
+            if policy['name'] not in policies:
+                operations.append({
+                    'action': 'create_policy',
+                    'name': policy['name'],
+                    'document': document,
+                    'description': policy.get('description', '')
+                })
+            elif _normalize_document(documents[policy['name']]) != _normalize_document(document):
+                operations.append({
+                    'action': 'update_policy',
+                    'name': policy['name'],
+                    'arn': policies[policy['name']]['Arn'],
+                    'document': document
+                })
+
+        for role in spec.get('roles', []):
+            document = _trust_document(role['services'])
+            description = role.get('description', '')
+            current = roles.get(role['name'])
+            if current is None:
+                operations.append({
+                    'action': 'create_role',
+                    'name': role['name'],
+                    'document': document,
+                    'description': description
+                })
+                continue
+            if _normalize_document(current['AssumeRolePolicyDocument']) != _normalize_document(document):
+                operations.append({'action': 'update_trust', 'name': role['name'], 'document': document})
+            if current.get('Description', '') != description:
+                operations.append({'action': 'update_description', 'name': role['name'], 'description': description})
+
+        desired = {}
+        for attachment in spec.get('attachments', []):
+            arn = self._policy_arn(attachment['policy'], policies)
+            desired.setdefault(attachment['role'], set()).add(arn)
+        for role_name, arns in desired.items():
+            for arn in sorted(arns - attached.get(role_name, set())):
+                operations.append({'action': 'attach', 'role': role_name, 'arn': arn})
+        if prune:
+            for role_name, arns in attached.items():
+                for arn in sorted(arns - desired.get(role_name, set())):
+                    operations.append({'action': 'detach', 'role': role_name, 'arn': arn})
+
+        return operations
+
+    def _execute(self, operation):
+        action = operation['action']
+        if action == 'create_policy':
+            return self._call(
+                'create_policy',
+                PolicyName=operation['name'],
+                Description=operation['description'],
+                PolicyDocument=json.dumps(operation['document'])
+            )
+        if action == 'update_policy':
+            # A policy keeps at most five versions, make room by deleting the oldest non-default one
+            versions = self._call('list_policy_versions', PolicyArn=operation['arn'])['Versions']
+            if len(versions) >= 5:
+                oldest = min((version for version in versions if not version['IsDefaultVersion']),
+                             key=lambda version: version['CreateDate'])
+                self._call('delete_policy_version', PolicyArn=operation['arn'], VersionId=oldest['VersionId'])
+            return self._call(
+                'create_policy_version',
+                PolicyArn=operation['arn'],
+                PolicyDocument=json.dumps(operation['document']),
+                SetAsDefault=True
+            )
+        if action == 'create_role':
+            return self._call(
+                'create_role',
+                RoleName=operation['name'],
+                AssumeRolePolicyDocument=json.dumps(operation['document']),
+                Description=operation['description']
             )
+        if action == 'update_trust':
+            return self._call(
+                'update_assume_role_policy',
+                RoleName=operation['name'],
+                PolicyDocument=json.dumps(operation['document'])
+            )
+        if action == 'update_description':
+            return self._call('update_role', RoleName=operation['name'], Description=operation['description'])
+
+        # Roles and policies created a moment ago are not visible to every IAM endpoint yet
+        retry_codes = general.RETRYABLE_ERROR_CODES | {'NoSuchEntity'}
+        if action == 'attach':
+            return self._call('attach_role_policy', retry_codes=retry_codes,
+                              RoleName=operation['role'], PolicyArn=operation['arn'])
+        return self._call('detach_role_policy', retry_codes=retry_codes,
+                          RoleName=operation['role'], PolicyArn=operation['arn'])
+
+    def _invalidate(self, operation):
+        if operation['action'] in ('create_policy', 'update_policy'):
+            arn = operation.get('arn') or f"arn:aws:iam::{self.aws_id}:policy/{operation['name']}"
+            cache.metadata_cache.pop(('iam', 'policy', arn))
+        elif operation['action'] in ('attach', 'detach'):
+            cache.metadata_cache.pop(('iam', 'role', operation['role']))
+            cache.metadata_cache.pop(('iam', 'policy', operation['arn']))
+        else:
+            cache.metadata_cache.pop(('iam', 'role', operation['name']))
+
+    def apply(self, spec, prune=False, dry_run=False):
 
-            return_response['status_code'] = response['ResponseMetadata']['HTTPStatusCode']
-            return_response['content'] = response
-        except ClientError as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
-        except Exception as e:
-            return_response['status_code'] = 500
-            return_response['content'] = e
+        """
+        Bring the account in line with spec. Roles and policies are created and updated concurrently first,
+        attachments follow once the role and policy they depend on exist.
+
+        :param spec: Desired state, see plan
+        :param prune: Also detach policies of the roles in the spec that are not in its attachments (optional, default = False)
+        :param dry_run: Only return the plan, do not change anything (optional, default = False)
+        :return: {"plan": operations, "succeeded": operations, "failed": operations}, a failed operation
+                 has an extra "error" with the exception
+        """
 
-        return return_response
+        operations = self.plan(spec, prune=prune)
+        result = {'plan': operations, 'succeeded': [], 'failed': []}
+        if dry_run:
+            return result
+
+        failed_names = set()
+        first = [operation for operation in operations if operation['action'] not in ('attach', 'detach')]
+        second = [operation for operation in operations if operation['action'] in ('attach', 'detach')]
+
+        for phase in (first, second):
+            runnable = []
+            for operation in phase:
+                if operation.get('role') in failed_names or operation.get('arn') in failed_names:
+                    result['failed'].append(dict(operation, error=Exception('A dependency of this operation failed')))
+                else:
+                    runnable.append(operation)
+            for operation, response, error in general.map_concurrently(self._execute, runnable, self.max_workers):
+                self._invalidate(operation)
+                if error is None:
+                    result['succeeded'].append(operation)
+                    continue
+                result['failed'].append(dict(operation, error=error))
+                if operation['action'] == 'create_role':
+                    failed_names.add(operation['name'])
+                elif operation['action'] == 'create_policy':
+                    failed_names.add(f"arn:aws:iam::{self.aws_id}:policy/{operation['name']}")
+
+        return result
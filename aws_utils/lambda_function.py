@@ -1,24 +1,166 @@
-import boto3
+import base64
+import copy
+import gzip
+import hashlib
 import json
-from aws_utils import general
+import os
+import time
+from aws_utils import cache, clients, general
+
+# Maximum invocation payload sizes of Lambda
+ASYNC_PAYLOAD_LIMIT = 256 * 1024
+SYNC_PAYLOAD_LIMIT = 6 * 1024 * 1024
+
+# Keys of the wrapper objects that execute_batch and execute put around payloads, see unpack_event
+ENVELOPE_KEY = 'aws_utils_envelope'
+COMPRESSED_KEY = 'aws_utils_gzip'
+POINTER_KEY = 'aws_utils_s3'
+
+# Files and directories left out of deployment packages, matched against every file and directory name
+DEFAULT_PACKAGE_EXCLUDE = ('__pycache__', '*.pyc', '.git', '.DS_Store')
+
+
+def pack_envelopes(payloads, max_bytes=ASYNC_PAYLOAD_LIMIT):
+    """
+    Group payloads into envelopes {ENVELOPE_KEY: [payload, ...]} whose JSON stays within max_bytes.
+    A payload that does not fit in an envelope on its own gets an envelope of its own.
+    Returns a generator, so the payloads are read lazily.
+    """
+    overhead = len(json.dumps({ENVELOPE_KEY: []}))
+    batch = []
+    size = overhead
+    for payload in payloads:
+        payload_size = len(json.dumps(payload)) + 2
+        if batch and size + payload_size > max_bytes:
+            yield {ENVELOPE_KEY: batch}
+            batch = []
+            size = overhead
+        batch.append(payload)
+        size += payload_size
+    if batch:
+        yield {ENVELOPE_KEY: batch}
+
+
+def build_package(source_dir, exclude=DEFAULT_PACKAGE_EXCLUDE):
+    """
+    Zip a source directory deterministically: the same files give the same bytes, whatever their mtimes or the
+    order of the directory listing, so the hash of the package identifies the code.
+
+    :param source_dir: Directory with the code of the function
+    :param exclude: fnmatch patterns of file and directory names to leave out (optional)
+    :return: (zip bytes, hex sha256 of the zip)
+    """
+    import fnmatch
+    import io
+    import zipfile
+
+    def excluded(name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        for directory, directory_names, file_names in os.walk(source_dir):
+            directory_names[:] = sorted(name for name in directory_names if not excluded(name))
+            for file_name in sorted(file_names):
+                if excluded(file_name):
+                    continue
+                path = os.path.join(directory, file_name)
+                info = zipfile.ZipInfo(os.path.relpath(path, source_dir).replace(os.sep, '/'), (1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                # Keep only the executable bit, the runtime needs it for bootstrap files and binaries
+                mode = 0o755 if os.stat(path).st_mode & 0o111 else 0o644
+                info.external_attr = (0o100000 | mode) << 16
+                with open(path, 'rb') as f:
+                    archive.writestr(info, f.read(), compresslevel=9)
+    body = buffer.getvalue()
+    return body, hashlib.sha256(body).hexdigest()
+
+
+def unpack_event(event, s3=None):
+    """
+    Handler side counterpart of execute and execute_batch: resolve an offloaded or compressed event and
+    return the list of payloads it carries (a single payload for a plain event).
+
+    :param event: Event received by the handler
+    :param s3: aws_utils.s3.S3 instance to fetch offloaded payloads with (optional)
+    """
+    if isinstance(event, dict) and POINTER_KEY in event:
+        if s3 is None:
+            from aws_utils.s3 import S3
+
+            s3 = S3(None, None)
+        pointer = event[POINTER_KEY]
+        response = s3.get(pointer['bucket'], pointer['key'])
+        if response['status_code'] != 200:
+            raise response['content']
+        event = json.loads(gzip.decompress(response['content']['Body'].read()))
+    elif isinstance(event, dict) and COMPRESSED_KEY in event:
+        event = json.loads(gzip.decompress(base64.b64decode(event[COMPRESSED_KEY])))
+
+    if isinstance(event, dict) and ENVELOPE_KEY in event:
+        return event[ENVELOPE_KEY]
+    return [event]
 
 
 class Lambda:
+    connection = clients.LazyClient('lambda')
+
     def __init__(self, region, aws_id):
         self.region = region
         self.aws_id = aws_id
-        self.connection = boto3.client('lambda',  region_name=region)
 
-    def get(self, arn):
+    @staticmethod
+    def _split_identifier(arn):
+        # name[:qualifier], account:function:name[:qualifier] or arn:aws:lambda:region:account:function:name[:qualifier]
+        name, _, qualifier = arn.split(':function:')[-1].partition(':')
+        return name, qualifier or None
+
+    def _cache_key(self, arn):
+        # Functions are cached under their name, whatever identifier the caller passed
+        return 'lambda', self.region, self._split_identifier(arn)[0]
+
+    def _invalidate(self, arn):
+        cache.metadata_cache.pop(self._cache_key(arn))
+
+    def get(self, arn, use_cache=True):
 
         """
-        :param arn:
+        :param arn: Arn or name of the Lambda function
+        :param use_cache: Serve the function from the shared metadata cache when present (optional, default = True).
+                          Only unqualified functions are cached, a version or alias is always read from Lambda.
         :return:
         """
 
-        return general.handle_action(self.connection.get_function(
-                FunctionName=arn
-            ))
+        cacheable = self._split_identifier(arn)[1] is None
+        cached = cache.metadata_cache.get(self._cache_key(arn)) if use_cache and cacheable else None
+        if cached is not None:
+            return {'status_code': 200, 'content': copy.deepcopy(cached)}
+
+        response = general.handle_action(
+            self.connection.get_function,
+            FunctionName=arn
+        )
+        if cacheable and response['status_code'] == 200:
+            cache.metadata_cache.put(self._cache_key(arn), copy.deepcopy(response['content']))
+        return response
+
+    def warm_cache(self):
+
+        """
+        Prefetch every function of the region into the shared metadata cache with paginated list_functions calls.
+        Functions from a listing only hold Configuration, not Code or Tags; call get with use_cache=False when
+        you need those.
+
+        :return: number of cached functions
+        """
+
+        count = 0
+        for page in general.iter_pages(self.connection.list_functions):
+            for configuration in page['Functions']:
+                response = {'Configuration': configuration, 'ResponseMetadata': {'HTTPStatusCode': 200}}
+                cache.metadata_cache.put(self._cache_key(configuration['FunctionName']), response)
+                count += 1
+        return count
 
     def create(self, name, runtime, s3_bucket, s3_key, handler, role, timeout=180, publish=True, description=''):
         """
@@ -35,7 +177,9 @@ class Lambda:
         :return:
         """
 
-        return general.handle_action(self.connection.create_function(
+        self._invalidate(name)
+        return general.handle_action(
+            self.connection.create_function,
             Code={
                 'S3Bucket': s3_bucket,
                 'S3Key': s3_key
@@ -47,20 +191,245 @@ class Lambda:
             Role=role,
             Timeout=timeout,
             Runtime=runtime
-        ))
+        )
+
+    def update_code(self, name, s3_bucket, s3_key, publish=True):
+
+        """
+        :param name: Name or arn of the Lambda function
+        :param s3_bucket: S3 bucket where the code is stored
+        :param s3_key: S3 key of the zip file with the code
+        :param publish: Publish a new version (optional, default = True)
+        :return: if successfull - Returns status_code = 200 with content = configuration of the function.
+                 Otherwise - status_code = 500 with content = Error information
+        """
+
+        self._invalidate(name)
+        return general.handle_action(
+            self.connection.update_function_code,
+            FunctionName=name,
+            S3Bucket=s3_bucket,
+            S3Key=s3_key,
+            Publish=publish
+        )
+
+    def deploy(self, name, source_dir, s3_bucket, s3_prefix='lambda-code/', runtime=None, handler=None, role=None,
+               timeout=180, publish=True, description='', exclude=DEFAULT_PACKAGE_EXCLUDE, use_cache=True, s3=None):
+
+        """
+        Zip source_dir deterministically and deploy it only when the code differs from the deployed code. The
+        package is stored under its sha256 in s3_prefix and only uploaded when that key does not exist yet.
+        Unknown functions are created, which needs runtime, handler and role.
+
+        :param name: Name of the Lambda function
+        :param source_dir: Directory with the code of the function
+        :param s3_bucket: S3 bucket for the packages
+        :param s3_prefix: Key prefix of the packages (optional, default = lambda-code/)
+        :param runtime: Runtime for a new function, e.g. python3.11 (optional)
+        :param handler: Handler for a new function, e.g. src.main.lambda_handler (optional)
+        :param role: Arn of the role for a new function (optional)
+        :param timeout: Timeout in seconds for a new function (optional, default = 180)
+        :param publish: Publish a new version (optional, default = True)
+        :param description: Description for a new function (optional)
+        :param exclude: fnmatch patterns of names left out of the package, see build_package (optional)
+        :param use_cache: Compare against the shared metadata cache, see warm_cache (optional, default = True)
+        :param s3: aws_utils.s3.S3 instance for the upload (optional)
+        :return: status_code and content as returned by create or update_code, plus "action" = "created",
+                 "updated" or "unchanged". An unchanged function returns status_code = 304 with content = its
+                 configuration.
+        """
+
+        body, digest = build_package(source_dir, exclude)
+        code_sha256 = base64.b64encode(bytes.fromhex(digest)).decode()
+
+        response = self.get(name, use_cache=use_cache)
+        if response['status_code'] == 200:
+            configuration = response['content']['Configuration']
+            if configuration.get('CodeSha256') == code_sha256:
+                return {'status_code': 304, 'content': configuration, 'action': 'unchanged'}
+        elif general.error_code(response['content']) != 'ResourceNotFoundException':
+            return dict(response, action=None)
+        elif None in (runtime, handler, role):
+            raise ValueError(f"Function {name} does not exist, creating it needs runtime, handler and role")
+
+        if s3 is None:
+            from aws_utils.s3 import S3
+
+            s3 = S3(self.region, self.aws_id)
+        key = f"{s3_prefix}{digest}.zip"
+        if not s3.key_exists(s3_bucket, key):
+            upload = s3.put(s3_bucket, key, body, 'application/zip')
+            if upload['status_code'] != 200:
+                return dict(upload, action=None)
+
+        if response['status_code'] == 200:
+            response, action = self.update_code(name, s3_bucket, key, publish=publish), 'updated'
+        else:
+            response, action = self.create(name, runtime, s3_bucket, key, handler, role, timeout=timeout,
+                                           publish=publish, description=description), 'created'
+        return dict(response, action=action if response['status_code'] < 300 else None)
+
+    def deploy_many(self, functions, s3_bucket, s3_prefix='lambda-code/', max_workers=8, **defaults):
+
+        """
+        Deploy many functions concurrently with deploy. The code of every function is first compared against one
+        paginated listing of the region (warm_cache) instead of a get_function call per function.
+
+        :param functions: Iterable of deploy keyword arguments per function, each with at least name and source_dir
+        :param s3_bucket: S3 bucket for the packages
+        :param s3_prefix: Key prefix of the packages (optional, default = lambda-code/)
+        :param max_workers: Number of functions deployed at the same time (optional, default = 8)
+        :param defaults: deploy keyword arguments shared by every function, e.g. runtime or role (optional)
+        :return: generator yielding (name, response) per function, response as returned by deploy
+        """
+
+        from aws_utils.s3 import S3
+
+        self.warm_cache()
+        s3 = S3(self.region, self.aws_id)
+
+        def deploy(function):
+            return self.deploy(s3_bucket=s3_bucket, s3_prefix=s3_prefix, s3=s3, **dict(defaults, **function))
+
+        for function, response, error in general.map_concurrently(deploy, functions, max_workers=max_workers):
+            if error is not None:
+                response = {'status_code': 500, 'content': error, 'action': None}
+            yield function['name'], response
+
+    def execute(self, arn, payload=None, sync=False, offload_bucket=None, offload_prefix='lambda-payloads/'):
+
+        """
+        :param arn: Arn or name of the Lambda function
+        :param payload: Payload of the invocation (optional)
+        :param sync: Wait for the result (optional, default = False)
+        :param offload_bucket: S3 bucket for payloads above the invocation limit (optional). Such a payload is
+                               sent gzip compressed when that fits, otherwise it is uploaded compressed to this
+                               bucket and the function receives a pointer. Use unpack_event in the handler.
+        :param offload_prefix: Key prefix of offloaded payloads (optional, default = lambda-payloads/)
+        :return: if successfull - Returns status_code = 200 (sync) or 202 (async) with content = response information.
+                 Otherwise - status_code = 500 with content = Error information
+        """
 
-    def execute(self, arn, payload=None, sync=False):
         if sync:
             event_type = 'RequestResponse'
         else:
             event_type = 'Event'
 
+        body = json.dumps(payload)
+        limit = SYNC_PAYLOAD_LIMIT if sync else ASYNC_PAYLOAD_LIMIT
+        if len(body) > limit and offload_bucket is not None:
+            compressed = gzip.compress(body.encode())
+            inline = json.dumps({COMPRESSED_KEY: base64.b64encode(compressed).decode()})
+            if len(inline) <= limit:
+                body = inline
+            else:
+                from aws_utils.s3 import S3
+
+                key = f"{offload_prefix}{hashlib.sha256(compressed).hexdigest()}.json.gz"
+                response = S3(self.region, self.aws_id).put(offload_bucket, key, compressed, 'application/gzip')
+                if response['status_code'] != 200:
+                    return response
+                body = json.dumps({POINTER_KEY: {'bucket': offload_bucket, 'key': key}})
+
         # Invoke the Lambda function
-        return general.handle_action(self.connection.invoke(
+        return general.handle_action(
+            self.connection.invoke,
             FunctionName=arn,
             InvocationType=event_type,  # 'RequestResponse' (sync) or 'Event' (async)
-            Payload=json.dumps(payload)
-        ))
+            Payload=body
+        )
+
+    def execute_batch(self, arn, payloads, sync=False, max_bytes=None, max_workers=8, offload_bucket=None,
+                      offload_prefix='lambda-payloads/'):
+
+        """
+        Pack many small payloads into size-bounded envelopes and invoke the function once per envelope.
+        The handler gets the payloads back with unpack_event.
+
+        :param arn: Arn or name of the Lambda function
+        :param payloads: Iterable of payloads, may be a generator
+        :param sync: Wait for the results (optional, default = False)
+        :param max_bytes: Maximum size of an envelope (optional, default = the invocation limit)
+        :param max_workers: Number of invocations running at the same time (optional, default = 8)
+        :param offload_bucket: S3 bucket for envelopes above the invocation limit, see execute (optional)
+        :param offload_prefix: Key prefix of offloaded envelopes (optional)
+        :return: generator yielding (envelope, response) per invocation, response as returned by execute
+        """
+
+        if max_bytes is None:
+            max_bytes = SYNC_PAYLOAD_LIMIT if sync else ASYNC_PAYLOAD_LIMIT
+
+        def invoke(envelope):
+            return self.execute(arn, envelope, sync=sync, offload_bucket=offload_bucket,
+                                offload_prefix=offload_prefix)
+
+        for envelope, response, error in general.map_concurrently(invoke, pack_envelopes(payloads, max_bytes),
+                                                                   max_workers=max_workers):
+            if error is not None:
+                response = {'status_code': 500, 'content': error}
+            yield envelope, response
+
+    def map(self, arn, payloads, sync=True, max_workers=32, ordered=False, max_retries=5, log_tail=False):
+
+        """
+        Invoke a function once for every payload with bounded concurrency.
+
+        :param arn: Arn or name of the Lambda function
+        :param payloads: Iterable of payloads, may be a generator
+        :param sync: True - wait for every result (RequestResponse). False - fire events (Event) (optional)
+        :param max_workers: Number of invocations running at the same time (optional, default = 32)
+        :param ordered: Yield results in the order of the payloads instead of completion order (optional)
+        :param max_retries: Retries of a throttled invocation with jittered backoff (optional, default = 5)
+        :param log_tail: Return the last 4 KB of the execution log of sync invocations (optional)
+        :return: generator yielding per payload {"index", "status_code", "content", "result", "function_error",
+                 "log", "latency"}. result is the decoded response payload of a sync invocation, function_error is
+                 set when the function raised, latency is in seconds including retries.
+        """
+
+        invocation_type = 'RequestResponse' if sync else 'Event'
+
+        def invoke(indexed_payload):
+            invoke_kwargs = {
+                'FunctionName': arn,
+                'InvocationType': invocation_type,
+                'Payload': json.dumps(indexed_payload[1])
+            }
+            if log_tail and sync:
+                invoke_kwargs['LogType'] = 'Tail'
+
+            started = time.monotonic()
+            response = general.call_with_backoff(self.connection.invoke, max_retries=max_retries, **invoke_kwargs)
+            result = None
+            if sync:
+                body = response['Payload'].read()
+                result = json.loads(body) if body else None
+            return response, result, time.monotonic() - started
+
+        for (index, _), outcome, error in general.map_concurrently(invoke, enumerate(payloads),
+                                                                    max_workers=max_workers, ordered=ordered):
+            if error is not None:
+                yield {
+                    'index': index,
+                    'status_code': 500,
+                    'content': error,
+                    'result': None,
+                    'function_error': None,
+                    'log': None,
+                    'latency': None
+                }
+                continue
+
+            response, result, latency = outcome
+            log = response.get('LogResult')
+            yield {
+                'index': index,
+                'status_code': response['StatusCode'],
+                'content': response,
+                'result': result,
+                'function_error': response.get('FunctionError'),
+                'log': base64.b64decode(log).decode('utf-8', 'replace') if log else None,
+                'latency': latency
+            }
 
     def delete(self, arn):
 
@@ -69,6 +438,9 @@ class Lambda:
         :return:
         """
 
-        return general.handle_action(self.connection.delete_function(
-                FunctionName=arn
-            ))
+        response = general.handle_action(
+            self.connection.delete_function,
+            FunctionName=arn
+        )
+        self._invalidate(arn)
+        return response
@@ -0,0 +1,386 @@
+import threading
+import time
+
+# Upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+# The parameter that names the table, bucket or function of a call, reported as its resource
+_RESOURCE_PARAMS = ('TableName', 'Bucket', 'FunctionName', 'RoleName', 'PolicyArn')
+
+_CONTEXT_KEY = 'aws_utils_metrics'
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+
+        """
+        :param fraction: Percentile as a fraction, e.g. 0.99
+        :return: upper bound of the bucket that holds the percentile, capped at the largest value
+        """
+
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'min': _round(self.min),
+            'max': _round(self.max),
+            'avg': _round(self.sum / self.count if self.count else None),
+            'p50': _round(self.percentile(0.5)),
+            'p90': _round(self.percentile(0.9)),
+            'p99': _round(self.percentile(0.99)),
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts) if count}
+        }
+
+
+class Registry:
+    def __init__(self):
+
+        """
+        Thread safe counters of the AWS calls, per (service, operation, resource).
+        """
+
+        self.started = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        entry = self._stats.get(key)
+        if entry is None:
+            entry = self._stats[key] = {
+                'calls': 0,
+                'errors': 0,
+                'throttles': 0,
+                'retries': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'consumed_capacity': 0.0,
+                'latency': Histogram()
+            }
+        return entry
+
+    def record_call(self, service, operation, resource, milliseconds, error_code=None, retries=0, bytes_sent=0,
+                    bytes_received=0, consumed_capacity=0.0):
+        from aws_utils.general import THROTTLING_ERROR_CODES
+
+        throttled = error_code in THROTTLING_ERROR_CODES
+        with self._lock:
+            entry = self._entry((service, operation, resource))
+            entry['calls'] += 1
+            entry['retries'] += retries
+            entry['bytes_sent'] += bytes_sent
+            entry['bytes_received'] += bytes_received
+            entry['consumed_capacity'] += consumed_capacity
+            entry['latency'].add(milliseconds)
+            if error_code is not None:
+                entry['errors'] += 1
+                if throttled:
+                    entry['throttles'] += 1
+
+    def record_retry(self, service, operation, resource=None):
+        with self._lock:
+            self._entry((service, operation, resource))['retries'] += 1
+
+    def snapshot(self):
+
+        """
+        :return: {"since": start of the measurement as unix time, "calls": [...]} with per (service, operation,
+                 resource) the number of calls, errors, throttles, retries, bytes sent and received, consumed
+                 DynamoDB capacity units and the latency histogram in milliseconds
+        """
+
+        with self._lock:
+            calls = []
+            for (service, operation, resource), entry in sorted(self._stats.items(), key=lambda item: str(item[0])):
+                calls.append(dict(
+                    entry,
+                    service=service,
+                    operation=operation,
+                    resource=resource,
+                    latency=entry['latency'].snapshot()
+                ))
+            return {'since': self.started, 'calls': calls}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.started = time.time()
+
+
+registry = Registry()
+enabled = False
+consumed_capacity = True
+
+
+def _capacity_units(consumed):
+    if isinstance(consumed, list):
+        return sum(_capacity_units(entry) for entry in consumed)
+    if isinstance(consumed, dict):
+        return consumed.get('CapacityUnits', 0.0)
+    return 0.0
+
+
+def _body_size(body, headers=None):
+    # Query protocol services (IAM) send a dict of form fields, which is small
+    if body is None or isinstance(body, dict):
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    # Request bodies are never moved: s3transfer streams do not support seeking from a hook
+    length = (headers or {}).get('Content-Length')
+    if length is not None:
+        return int(length)
+    if hasattr(body, '__len__'):
+        return len(body)
+    if hasattr(body, 'getbuffer'):
+        try:
+            with body.getbuffer() as buffer:
+                return max(buffer.nbytes - body.tell(), 0)
+        except (ValueError, OSError):
+            return 0
+    return 0
+
+
+def resource_of(params):
+
+    """
+    :param params: API parameters of a call
+    :return: the table, bucket, function, role or policy the call is about, or None
+    """
+
+    return next((params[name] for name in _RESOURCE_PARAMS if isinstance(params.get(name), str)), None)
+
+
+def _before_parameter_build(params, model, context, **kwargs):
+    if not enabled:
+        return
+    context[_CONTEXT_KEY] = {'resource': resource_of(params)}
+    if (consumed_capacity and model.input_shape is not None and 'ReturnConsumedCapacity' in model.input_shape.members
+            and 'ReturnConsumedCapacity' not in params):
+        params['ReturnConsumedCapacity'] = 'TOTAL'
+
+
+def _before_call(model, params, context, **kwargs):
+    if not enabled:
+        return
+    call = context.setdefault(_CONTEXT_KEY, {'resource': None})
+    call['operation'] = model.name
+    call['service'] = model.service_model.service_name
+    call['bytes_sent'] = _body_size(params.get('body'), params.get('headers'))
+    call['started'] = time.perf_counter()
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    call = context.get(_CONTEXT_KEY)
+    if not call or 'started' not in call:
+        return
+    metadata = parsed.get('ResponseMetadata', {})
+    headers = getattr(http_response, 'headers', None) or {}
+    received = headers.get('content-length') or parsed.get('ContentLength') or 0
+    error_code = None
+    if getattr(http_response, 'status_code', 200) >= 300:
+        error_code = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+    registry.record_call(
+        call['service'],
+        call['operation'],
+        call['resource'],
+        (time.perf_counter() - call.pop('started')) * 1e3,
+        error_code=error_code,
+        retries=metadata.get('RetryAttempts', 0),
+        bytes_sent=call['bytes_sent'],
+        bytes_received=int(received),
+        consumed_capacity=_capacity_units(parsed.get('ConsumedCapacity'))
+    )
+
+
+def _after_call_error(exception, context, **kwargs):
+    call = context.get(_CONTEXT_KEY)
+    if not call or 'started' not in call:
+        return
+    registry.record_call(
+        call['service'],
+        call['operation'],
+        call['resource'],
+        (time.perf_counter() - call.pop('started')) * 1e3,
+        error_code=type(exception).__name__,
+        bytes_sent=call['bytes_sent']
+    )
+
+
+def instrument(client):
+
+    """
+    Register the metric hooks on a botocore client. The clients of aws_utils.clients are instrumented
+    automatically once enable() was called.
+
+    :param client: botocore client
+    :return: client
+    """
+
+    events = client.meta.events
+    events.register_last('before-parameter-build', _before_parameter_build,
+                         unique_id=f"{_CONTEXT_KEY}-before-parameter-build")
+    # First, so the hook also runs when another before-call handler answers the call
+    events.register_first('before-call', _before_call, unique_id=f"{_CONTEXT_KEY}-before-call")
+    events.register('after-call', _after_call, unique_id=f"{_CONTEXT_KEY}-after-call")
+    events.register('after-call-error', _after_call_error, unique_id=f"{_CONTEXT_KEY}-after-call-error")
+    return client
+
+
+def enable(capacity=True):
+
+    """
+    Start recording the calls of every client of aws_utils.clients, including the clients that already exist.
+
+    :param capacity: Ask DynamoDB for the ConsumedCapacity of every call that supports it (optional, default = True)
+    """
+
+    global enabled, consumed_capacity
+    from aws_utils import clients
+
+    consumed_capacity = capacity
+    enabled = True
+    clients.add_hook(instrument)
+
+
+def disable():
+
+    """
+    Stop recording. The counters stay available through snapshot().
+    """
+
+    global enabled
+    enabled = False
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def reset():
+    registry.reset()
+
+
+class LogExporter:
+    def __init__(self, logger=None, level=None):
+
+        """
+        Write one log line per (service, operation, resource).
+
+        :param logger: Logger to write to (optional, default = the aws_utils.metrics logger)
+        :param level: Log level of the lines (optional, default = logging.INFO)
+        """
+
+        import logging
+
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = logging.INFO if level is None else level
+
+    def export(self, snapshot):
+        for call in snapshot['calls']:
+            latency = call['latency']
+            self.logger.log(
+                self.level,
+                "%s.%s resource=%s calls=%d errors=%d throttles=%d retries=%d p50=%sms p99=%sms max=%sms "
+                "bytes_sent=%d bytes_received=%d consumed_capacity=%s",
+                call['service'], call['operation'], call['resource'], call['calls'], call['errors'],
+                call['throttles'], call['retries'], latency['p50'], latency['p99'], latency['max'],
+                call['bytes_sent'], call['bytes_received'], call['consumed_capacity']
+            )
+
+
+class EMFExporter:
+    def __init__(self, namespace='aws_utils', write=print):
+
+        """
+        Write CloudWatch embedded metric format (EMF) JSON documents, one per (service, operation, resource).
+        Printed from a Lambda function, CloudWatch turns them into metrics without any API call.
+
+        :param namespace: CloudWatch namespace of the metrics (optional, default = aws_utils)
+        :param write: Callable that receives every JSON line (optional, default = print)
+        """
+
+        self.namespace = namespace
+        self.write = write
+
+    def export(self, snapshot):
+        import json
+
+        timestamp = int(time.time() * 1000)
+        for call in snapshot['calls']:
+            latency = call['latency']
+            values = {
+                'Calls': (call['calls'], 'Count'),
+                'Errors': (call['errors'], 'Count'),
+                'Throttles': (call['throttles'], 'Count'),
+                'Retries': (call['retries'], 'Count'),
+                'BytesSent': (call['bytes_sent'], 'Bytes'),
+                'BytesReceived': (call['bytes_received'], 'Bytes'),
+                'ConsumedCapacity': (call['consumed_capacity'], 'Count'),
+                'LatencyAvg': (latency['avg'], 'Milliseconds'),
+                'LatencyP50': (latency['p50'], 'Milliseconds'),
+                'LatencyP99': (latency['p99'], 'Milliseconds')
+            }
+            values = {name: value for name, value in values.items() if value[0] is not None}
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['Service', 'Operation', 'Resource']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+                    }]
+                },
+                'Service': call['service'],
+                'Operation': call['operation'],
+                'Resource': call['resource'] or '-'
+            }
+            document.update({name: value for name, (value, _) in values.items()})
+            self.write(json.dumps(document))
+
+
+def export(*exporters, reset_after=False):
+
+    """
+    :param exporters: Exporters to pass the current snapshot to, e.g. LogExporter(), EMFExporter()
+    :param reset_after: Reset the counters after exporting, so every export covers one interval (optional)
+    :return: the exported snapshot
+    """
+
+    current = registry.snapshot()
+    for exporter in exporters:
+        exporter.export(current)
+    if reset_after:
+        registry.reset()
+    return current
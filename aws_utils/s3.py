@@ -1,13 +1,267 @@
-import boto3
-from botocore.exceptions import ClientError
-from aws_utils import general
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from aws_utils import clients, general
+from aws_utils.cache import LRUCache
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 10
+# Size of the reads from a response body while a part is written to its destination
+_CHUNK_SIZE = 1024 * 1024
+# Maximum number of keys of one delete_objects request and of one list_objects_v2 page
+_BATCH_SIZE = 1000
+# Maximum number of parts of a multipart upload and the part sizes S3 accepts
+_MAX_PARTS = 10000
+_MIN_PART_SIZE = 5 * 1024 * 1024
+_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+# botocore retries of the client used by s3transfer, which does not go through general.call_with_backoff
+TRANSFER_RETRIES = {'mode': 'standard', 'total_max_attempts': 5}
+# Name of the manifest sync keeps in the local directory
+SYNC_MANIFEST = '.aws_utils_sync.json'
+
+
+def transfer_config(part_size=DEFAULT_PART_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    Build the boto3 TransferConfig for multipart transfers with the given part size and concurrency.
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+        use_threads=max_concurrency > 1
+    )
+
+
+class IterableReader(io.RawIOBase):
+    def __init__(self, chunks):
+
+        """
+        Read-only file-like object over an iterable of bytes chunks, so a generator can be uploaded
+        without buffering it completely.
+
+        :param chunks: Iterable of bytes, e.g. a generator yielding parts of an export
+        """
+
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Fill the whole buffer unless the iterable is exhausted: s3transfer treats a short read as the end
+        # of a non-seekable stream
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view):
+            if not self._pending:
+                try:
+                    self._pending = memoryview(bytes(next(self._chunks)))
+                except StopIteration:
+                    break
+                continue
+            size = min(len(view) - filled, len(self._pending))
+            view[filled:filled + size] = self._pending[:size]
+            self._pending = self._pending[size:]
+            filled += size
+        return filled
+
+
+def local_etag(path, part_size=DEFAULT_PART_SIZE):
+
+    """
+    Compute the ETag S3 gives a file uploaded with S3.upload / S3.create and the same part_size: the MD5 of the
+    file, or for a multipart upload the MD5 of the part MD5s followed by the number of parts.
+
+    :param path: Path of the file
+    :param part_size: Part size of the upload (optional, default = 8 MB)
+    :return: the quoted ETag, e.g. "9b2cf535f27731c974343645a3985328-3"
+    """
+
+    size = os.path.getsize(path)
+    if size < part_size:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return f'"{digest.hexdigest()}"'
+
+    # Same as the ChunksizeAdjuster of s3transfer: double the part size until the upload fits in the maximum
+    # number of parts, then clamp it to the part sizes S3 accepts. The threshold itself is not adjusted.
+    while -(-size // part_size) > _MAX_PARTS:
+        part_size *= 2
+    part_size = min(max(part_size, _MIN_PART_SIZE), _MAX_PART_SIZE)
+    part_digests = []
+    with open(path, 'rb') as f:
+        for _ in range(-(-size // part_size)):
+            digest = hashlib.md5()
+            remaining = part_size
+            while remaining:
+                chunk = f.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+            part_digests.append(digest.digest())
+    return f'"{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}"'
+
+
+def _encode_response(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__} in the object cache")
+
+
+def _decode_response(value):
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+class ObjectCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60, max_object_bytes=None, disk_dir=None,
+                 disk_max_bytes=None):
+
+        """
+        Read-through cache for S3.get. Objects are kept in an in-memory LRU and optionally in a directory that
+        survives warm invocations (e.g. /tmp in Lambda). Within ttl an object is served without a request,
+        after that it is revalidated with a conditional GET on its ETag, which costs no transfer when the
+        object did not change. One cache can be shared by several S3 instances.
+
+        :param max_bytes: Maximum total size of the objects in memory (optional, default = 64 MB)
+        :param ttl: Seconds an object is served without revalidation, None = never revalidate (optional, default = 60)
+        :param max_object_bytes: Objects larger than this are not cached (optional, default = max_bytes)
+        :param disk_dir: Directory of the on-disk tier (optional, default = no disk tier)
+        :param disk_max_bytes: Maximum total size of the on-disk tier (optional, default = no cap)
+        """
+
+        self.ttl = ttl
+        self.max_object_bytes = max_bytes if max_object_bytes is None else max_object_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.memory = LRUCache(maxsize=2 ** 31, max_bytes=max_bytes, sizeof=lambda entry: len(entry['body']))
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, bucket_name, key_name):
+        name = hashlib.sha256(f"{bucket_name}/{key_name}".encode()).hexdigest()
+        return os.path.join(self.disk_dir, name)
+
+    def lookup(self, bucket_name, key_name):
+
+        """
+        :return: the cached entry {"body", "etag", "fetched", "response"} or None
+        """
+
+        entry = self.memory.get((bucket_name, key_name))
+        if entry is None and self.disk_dir is not None:
+            path = self._disk_path(bucket_name, key_name)
+            try:
+                with open(path + '.json') as f:
+                    entry = json.load(f, object_hook=_decode_response)
+                with open(path + '.body', 'rb') as f:
+                    entry['body'] = f.read()
+            except (OSError, ValueError):
+                return None
+            self.memory.put((bucket_name, key_name), entry)
+        return entry
+
+    def store(self, bucket_name, key_name, entry):
+        if len(entry['body']) > self.max_object_bytes:
+            return
+        self.memory.put((bucket_name, key_name), entry)
+        if self.disk_dir is None:
+            return
+
+        path = self._disk_path(bucket_name, key_name)
+        metadata = {name: value for name, value in entry.items() if name != 'body'}
+        # Write to temporary files of this writer first, so a concurrent reader never sees half an object and
+        # concurrent writers of the same key do not replace each other's files
+        temporary = []
+        try:
+            for content in (entry['body'], json.dumps(metadata, default=_encode_response).encode()):
+                descriptor, temporary_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+                temporary.append(temporary_path)
+                with open(descriptor, 'wb') as f:
+                    f.write(content)
+            os.replace(temporary[0], path + '.body')
+            os.replace(temporary[1], path + '.json')
+            if self.disk_max_bytes is not None:
+                self._prune_disk()
+        except OSError:
+            # The disk tier is best effort, the object stays cached in memory
+            for temporary_path in temporary:
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+
+    def _prune_disk(self):
+        files = [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.body')]
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.disk_max_bytes:
+                break
+            total -= entry.stat().st_size
+            for suffix in ('.body', '.json'):
+                try:
+                    os.remove(entry.path[:-len('.body')] + suffix)
+                except OSError:
+                    pass
+
+    def record(self, counter, saved=0):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.bytes_saved += saved
+
+    def stats(self):
+
+        """
+        :return: {"hits", "misses", "revalidations", "bytes_saved", "memory_bytes", "memory_objects"} where hits
+                 were served without a request and revalidations with a 304 Not Modified
+        """
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'bytes_saved': self.bytes_saved,
+                'memory_bytes': self.memory.bytes,
+                'memory_objects': len(self.memory)
+            }
 
 
 class S3:
-    def __init__(self, region, aws_id):
+    s3 = clients.LazyClient('s3', regional=False)
+    # s3transfer makes its calls directly, so the client of the transfers keeps the retries of botocore
+    s3_transfer = clients.LazyClient('s3', regional=False, retries=TRANSFER_RETRIES)
+
+    def __init__(self, region, aws_id, cache=None):
+
+        """
+        :param region: Preferred region, e.g. eu-central-1
+        :param aws_id: AWS Account ID
+        :param cache: ObjectCache that get reads through (optional, default = no caching)
+        """
+
         self.region = region
         self.aws_id = aws_id
-        self.s3 = boto3.client('s3')
+        self.cache = cache
 
     def get(self, bucket_name, key_name):
 
@@ -18,10 +272,53 @@ class S3:
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return general.handle_action(self.s3.get_object(Bucket=bucket_name, Key=key_name))
+        if self.cache is None:
+            return general.handle_action(self.s3.get_object, Bucket=bucket_name, Key=key_name)
+        return self._cached_get(bucket_name, key_name)
+
+    def _cached_get(self, bucket_name, key_name):
+        from botocore.response import StreamingBody
+
+        return_response = {
+            'status_code': '',
+            'content': ''
+        }
+
+        cache = self.cache
+        entry = cache.lookup(bucket_name, key_name)
+        if entry is not None and (cache.ttl is None or time.time() - entry['fetched'] < cache.ttl):
+            cache.record('hits', len(entry['body']))
+        else:
+            try:
+                get_kwargs = {'Bucket': bucket_name, 'Key': key_name}
+                if entry is not None:
+                    get_kwargs['IfNoneMatch'] = entry['etag']
+                response = general.call_with_backoff(self.s3.get_object, **get_kwargs)
+                body = response.pop('Body').read()
+                response.pop('ResponseMetadata', None)
+                entry = {'body': body, 'etag': response.get('ETag'), 'fetched': time.time(), 'response': response}
+                cache.record('misses')
+            except Exception as e:
+                if entry is None or general.error_code(e) not in ('304', 'NotModified'):
+                    return_response['status_code'] = 500
+                    return_response['content'] = e
+                    return return_response
+                entry = dict(entry, fetched=time.time())
+                cache.record('revalidations', len(entry['body']))
+            cache.store(bucket_name, key_name, entry)
+
+        body = entry['body']
+        return_response['status_code'] = 200
+        return_response['content'] = dict(
+            entry['response'],
+            Body=StreamingBody(io.BytesIO(body), len(body)),
+            ResponseMetadata={'HTTPStatusCode': 200}
+        )
+        return return_response
 
 
-    def create(self, bucket_name, key_name, file_path, metadata=None):
+    def create(self, bucket_name, key_name, file_path, metadata=None, part_size=DEFAULT_PART_SIZE,
+               max_concurrency=DEFAULT_MAX_CONCURRENCY):
 
         """
 
@@ -33,6 +330,8 @@ class S3:
                     "creation_date": "2024-10-11 09:30:30,
                     "description": "Just a file"
                 }
+        :param part_size: Size in bytes of the parts of a multipart upload (optional, default = 8 MB)
+        :param max_concurrency: Number of parts uploaded at the same time (optional, default = 10)
         :return: if successfull - Returns status_code = 201 with content = information of the created key.
                  Otherwise - status_code = 500 with content = Error information
 
@@ -42,41 +341,458 @@ class S3:
             'content': ''
         }
         try:
-            self.s3.upload_file(
+            self.s3_transfer.upload_file(
                 Filename=file_path,
                 Bucket=bucket_name,
                 Key=key_name,
-                ExtraArgs={"Metadata": metadata}
+                ExtraArgs={"Metadata": metadata} if metadata is not None else None,
+                Config=transfer_config(part_size, max_concurrency)
             )
             return_response['status_code'] = 201
             return_response['content'] = self.get(bucket_name=bucket_name, key_name=key_name)['content']
 
-        except ClientError as e:
+        except Exception as e:
+            return_response['status_code'] = 500
+            return_response['content'] = e
+
+        return return_response
+
+    def upload(self, bucket_name, key_name, source, content_type=None, metadata=None, part_size=DEFAULT_PART_SIZE,
+               max_concurrency=DEFAULT_MAX_CONCURRENCY):
+
+        """
+        :param bucket_name: Name of the S3 bucket
+        :param key_name: Name of the S3 filepath within the S3 bucket
+        :param source: What to upload - a file path, a readable file-like object (read in parts, so it may be a
+                       non-seekable stream) or an iterable of bytes chunks. Memory use stays around
+                       part_size * max_concurrency, whatever the size of the object.
+        :param content_type: Content type of the object (optional)
+        :param metadata: Metadata of the object as a json object (optional)
+        :param part_size: Size in bytes of the parts of a multipart upload (optional, default = 8 MB)
+        :param max_concurrency: Number of parts uploaded at the same time (optional, default = 10)
+        :return: if successfull - Returns status_code = 201 with content = head_object information of the created key.
+                 Otherwise - status_code = 500 with content = Error information
+        """
+
+        return_response = {
+            'status_code': '',
+            'content': ''
+        }
+
+        extra_args = {}
+        if content_type is not None:
+            extra_args['ContentType'] = content_type
+        if metadata is not None:
+            extra_args['Metadata'] = metadata
+
+        try:
+            config = transfer_config(part_size, max_concurrency)
+            if isinstance(source, (str, os.PathLike)):
+                self.s3_transfer.upload_file(Filename=os.fspath(source), Bucket=bucket_name, Key=key_name,
+                                             ExtraArgs=extra_args or None, Config=config)
+            else:
+                fileobj = source if hasattr(source, 'read') else IterableReader(source)
+                self.s3_transfer.upload_fileobj(Fileobj=fileobj, Bucket=bucket_name, Key=key_name,
+                                                ExtraArgs=extra_args or None, Config=config)
+
+            return_response['status_code'] = 201
+            return_response['content'] = general.call_with_backoff(self.s3.head_object, Bucket=bucket_name,
+                                                                   Key=key_name)
+        except Exception as e:
             return_response['status_code'] = 500
             return_response['content'] = e
+
+        return return_response
+
+    def download(self, bucket_name, key_name, destination=None, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+
+        """
+        :param bucket_name: Name of the S3 bucket
+        :param key_name: Key to download
+        :param destination: Where to write the object - a file path, or a writable buffer at least as large as the
+                            object (bytearray, mmap, memoryview). Default - an anonymous memory-mapped buffer, which
+                            the OS can page out instead of keeping the object on the python heap.
+        :param part_size: Size in bytes of the ranged GETs (optional, default = 8 MB)
+        :param max_concurrency: Number of ranges downloaded at the same time (optional, default = 10)
+        :return: if successfull - Returns status_code = 200 with content = head_object information plus
+                 "Destination" (the path or buffer that holds the object).
+                 Otherwise - status_code = 500 with content = Error information
+        """
+
+        return_response = {
+            'status_code': '',
+            'content': ''
+        }
+
+        try:
+            head = general.call_with_backoff(self.s3.head_object, Bucket=bucket_name, Key=key_name)
+            size = head['ContentLength']
+            ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+            if isinstance(destination, (str, os.PathLike)):
+                with open(destination, 'wb') as f:
+                    f.truncate(size)
+
+                def write_part(part):
+                    with open(destination, 'r+b') as f:
+                        f.seek(part[0])
+                        for chunk in self._iter_range(bucket_name, key_name, head['ETag'], part):
+                            f.write(chunk)
+            else:
+                if destination is None:
+                    # mmap does not accept a length of 0
+                    destination = mmap.mmap(-1, size) if size else bytearray()
+                view = memoryview(destination).cast('B')
+                if len(view) < size:
+                    raise ValueError(f"Destination holds {len(view)} bytes, the object is {size} bytes")
+
+                def write_part(part):
+                    offset = part[0]
+                    for chunk in self._iter_range(bucket_name, key_name, head['ETag'], part):
+                        view[offset:offset + len(chunk)] = chunk
+                        offset += len(chunk)
+
+            for _, _, error in general.map_concurrently(write_part, ranges, max_workers=max_concurrency):
+                if error is not None:
+                    raise error
+
+            return_response['status_code'] = 200
+            return_response['content'] = dict(head, Destination=destination)
         except Exception as e:
             return_response['status_code'] = 500
             return_response['content'] = e
 
         return return_response
 
-    def list(self, bucket_name):
+    def _iter_range(self, bucket_name, key_name, etag, part):
+        # IfMatch makes every range fail instead of mixing two versions when the object changes mid-download
+        response = general.call_with_backoff(self.s3.get_object, Bucket=bucket_name, Key=key_name,
+                                             Range=f"bytes={part[0]}-{part[1]}", IfMatch=etag)
+        yield from response['Body'].iter_chunks(_CHUNK_SIZE)
+
+    def iter_objects(self, bucket_name, prefix='', delimiter=None, start_after=None, page_size=None):
+
+        """
+        :param bucket_name: S3 Bucket name to list
+        :param prefix: Only list keys starting with this prefix (optional)
+        :param delimiter: Group keys on this character, e.g. / (optional). Every group is yielded once as
+                          {"Prefix": common prefix} instead of the keys below it.
+        :param start_after: Only list keys after this key (optional)
+        :param page_size: Maximum number of keys per request, at most 1000 (optional)
+        :return: generator yielding the object information of every key, following all continuation tokens
+        """
+
+        list_kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+        if delimiter:
+            list_kwargs['Delimiter'] = delimiter
+        if start_after:
+            list_kwargs['StartAfter'] = start_after
+        if page_size:
+            list_kwargs['MaxKeys'] = page_size
+
+        while True:
+            response = general.call_with_backoff(self.s3.list_objects_v2, **list_kwargs)
+            yield from response.get('CommonPrefixes', [])
+            yield from response.get('Contents', [])
+
+            if not response.get('IsTruncated'):
+                break
+            list_kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def list_parallel(self, bucket_name, prefix='', delimiter='/', depth=1, max_workers=16):
+
+        """
+        List a large keyspace concurrently: the common prefixes under prefix (up to depth levels deep) become
+        shards that are listed at the same time on a thread pool.
+
+        :param bucket_name: S3 Bucket name to list
+        :param prefix: Only list keys starting with this prefix (optional)
+        :param delimiter: Character that separates the levels of the keys (optional, default = /)
+        :param depth: Number of delimiter levels that are expanded into shards (optional, default = 1)
+        :param max_workers: Number of shards listed at the same time (optional, default = 16)
+        :return: generator yielding the object information of every key under prefix, in no particular order
+        """
+
+        shards = [prefix]
+        objects = []
+        for _ in range(depth):
+            next_shards = []
+            for shard in shards:
+                for entry in self.iter_objects(bucket_name, prefix=shard, delimiter=delimiter):
+                    if 'Prefix' in entry:
+                        next_shards.append(entry['Prefix'])
+                    else:
+                        objects.append(entry)
+            shards = next_shards
+
+        yield from objects
+        producers = [
+            lambda shard=shard: self.iter_objects(bucket_name, prefix=shard)
+            for shard in shards
+        ]
+        if producers:
+            yield from general.stream_concurrently(producers, max_workers=max_workers, buffer_size=1000)
+
+    def list(self, bucket_name, prefix='', delimiter=None, start_after=None):
         """
 
         :param bucket_name: S3 Bucket name get listed
-        :return: if successfull - Returns status_code = 200 with content = response information.
+        :param prefix: Only list keys starting with this prefix (optional)
+        :param delimiter: Group keys on this character, e.g. / (optional)
+        :param start_after: Only list keys after this key (optional)
+        :return: if successfull - Returns status_code = 200 with content = response information, where Contents and
+                 CommonPrefixes hold the entries of all pages. Use iter_objects to stream very large listings.
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return general.handle_action(self.s3.list_objects_v2(Bucket=bucket_name))
+        return_response = {
+            'status_code': '',
+            'content': ''
+        }
+
+        try:
+            contents = []
+            common_prefixes = []
+            for entry in self.iter_objects(bucket_name, prefix=prefix, delimiter=delimiter, start_after=start_after):
+                (common_prefixes if 'Prefix' in entry else contents).append(entry)
+
+            content = {
+                'Name': bucket_name,
+                'Prefix': prefix,
+                'KeyCount': len(contents) + len(common_prefixes),
+                'IsTruncated': False,
+                'Contents': contents,
+                'ResponseMetadata': {'HTTPStatusCode': 200}
+            }
+            if delimiter:
+                content['Delimiter'] = delimiter
+                content['CommonPrefixes'] = common_prefixes
+
+            return_response['status_code'] = 200
+            return_response['content'] = content
+        except Exception as e:
+            return_response['status_code'] = 500
+            return_response['content'] = e
+
+        return return_response
 
     def key_exists(self, bucket_name, key_name):
+        from botocore.exceptions import ClientError
+
         try:
-            self.s3.head_object(Bucket=bucket_name, Key=key_name)
+            general.call_with_backoff(self.s3.head_object, Bucket=bucket_name, Key=key_name)
             return True
         except ClientError:
             return False
 
+    def keys_exist(self, bucket_name, key_names, strategy='auto', max_workers=32, head_per_page=100):
+
+        """
+        :param bucket_name: S3 Bucket to check
+        :param key_names: Iterable of keys
+        :param strategy: list - answer from a listing of the keyspace between the smallest and largest key.
+                         head - one head_object per key, max_workers at the same time.
+                         auto - list at most one page per head_per_page keys, then HEAD whatever the
+                         listing did not reach (default).
+        :param max_workers: Number of head_object calls running at the same time (optional, default = 32)
+        :param head_per_page: Number of HEADs one listing page of 1000 keys is worth in auto (optional, default = 100)
+        :return: {key: True/False} for every key
+        """
+
+        from botocore.exceptions import ClientError
+
+        wanted = sorted(set(key_names))
+        result = dict.fromkeys(wanted, False)
+        if not wanted:
+            return result
+
+        if strategy not in ('auto', 'list', 'head'):
+            raise ValueError(f"Unsupported strategy: {strategy}")
+
+        unresolved = wanted
+        if strategy == 'list' or (strategy == 'auto' and len(wanted) >= head_per_page):
+            budget = None if strategy == 'list' else len(wanted) // head_per_page * _BATCH_SIZE
+            # A prefix of the smallest key sorts right before it
+            listing = self.iter_objects(bucket_name, prefix=os.path.commonprefix(wanted),
+                                        start_after=wanted[0][:-1] or None)
+            # Every key up to listed_up_to has been seen by the listing
+            listed_up_to = ''
+            for position, entry in enumerate(listing):
+                if budget is not None and position >= budget:
+                    break
+                listed_up_to = entry['Key']
+                if listed_up_to in result:
+                    result[listed_up_to] = True
+                if listed_up_to >= wanted[-1]:
+                    break
+            else:
+                listed_up_to = wanted[-1]
+
+            unresolved = [key for key in wanted if key > listed_up_to]
+
+        def head(key):
+            try:
+                general.call_with_backoff(self.s3.head_object, Bucket=bucket_name, Key=key)
+                return True
+            except ClientError:
+                return False
+
+        for key, exists, error in general.map_concurrently(head, unresolved, max_workers=max_workers):
+            result[key] = bool(exists) and error is None
+
+        return result
+
+    def sync(self, local_dir, bucket_name, prefix='', delete=False, dry_run=False, max_workers=8,
+             part_size=DEFAULT_PART_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY, manifest_path=None):
+
+        """
+        Upload the files of local_dir that differ from the keys under prefix and, with delete, remove the keys
+        that have no local file.
+        Files are compared on their ETag with one paginated listing of prefix. A manifest in local_dir keeps the
+        size, mtime and ETag of every file, so unchanged files are not hashed again on the next sync; it also
+        recognizes objects whose ETag is not an MD5 (e.g. SSE-KMS) as unchanged.
+
+        :param local_dir: Directory to upload
+        :param bucket_name: Name of the S3 bucket
+        :param prefix: Key prefix the directory is synced to, e.g. builds/v1 (optional, default = bucket root)
+        :param delete: Delete keys under prefix that have no local file, like aws s3 sync --delete (optional,
+                       default = False)
+        :param dry_run: Only return what would be uploaded and deleted (optional, default = False)
+        :param max_workers: Number of files hashed and uploaded at the same time (optional, default = 8)
+        :param part_size: Part size of multipart uploads of large files (optional, default = 8 MB)
+        :param max_concurrency: Number of parts of one file uploaded at the same time (optional, default = 10)
+        :param manifest_path: Path of the manifest (optional, default = .aws_utils_sync.json in local_dir)
+        :return: {"uploaded": [keys], "deleted": [keys], "unchanged": number of files, "bytes_uploaded": bytes,
+                 "failed": {key: error}}
+        """
+
+        import mimetypes
+
+        prefix = prefix.rstrip('/') + '/' if prefix.strip('/') else ''
+        manifest_path = manifest_path or os.path.join(local_dir, SYNC_MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get('target') != [bucket_name, prefix, part_size]:
+            manifest = {'target': [bucket_name, prefix, part_size], 'files': {}}
+        known = manifest['files']
+
+        local = {}
+        for directory, _, file_names in os.walk(local_dir):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                if os.path.abspath(path) == os.path.abspath(manifest_path):
+                    continue
+                relative = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                local[prefix + relative] = (relative, path)
+
+        remote = {entry['Key']: entry for entry in self.iter_objects(bucket_name, prefix=prefix)}
+
+        def compare(key):
+            relative, path = local[key]
+            stat = os.stat(path)
+            entry = known.get(relative)
+            unchanged_locally = entry is not None and entry['size'] == stat.st_size and \
+                entry['mtime_ns'] == stat.st_mtime_ns
+            etag = entry['etag'] if unchanged_locally else local_etag(path, part_size)
+            remote_entry = remote.get(key)
+            in_sync = remote_entry is not None and remote_entry['Size'] == stat.st_size and (
+                remote_entry['ETag'] == etag or (unchanged_locally and remote_entry['ETag'] == entry.get('remote_etag'))
+            )
+            return {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'etag': etag,
+                'remote_etag': remote_entry['ETag'] if in_sync else None
+            }, in_sync
+
+        files = {}
+        uploads = []
+        for key, outcome, error in general.map_concurrently(compare, list(local), max_workers=max_workers):
+            if error is not None:
+                raise error
+            files[key], in_sync = outcome
+            if not in_sync:
+                uploads.append(key)
+        deletes = sorted(set(remote) - set(local)) if delete else []
+
+        result = {
+            'uploaded': sorted(uploads),
+            'deleted': deletes,
+            'unchanged': len(local) - len(uploads),
+            'bytes_uploaded': sum(files[key]['size'] for key in uploads),
+            'failed': {}
+        }
+        if dry_run:
+            return result
+
+        def upload(key):
+            response = self.upload(bucket_name, key, local[key][1], content_type=mimetypes.guess_type(key)[0],
+                                   part_size=part_size, max_concurrency=max_concurrency)
+            if response['status_code'] != 201:
+                raise response['content']
+            return response['content'].get('ETag')
+
+        for key, etag, error in general.map_concurrently(upload, uploads, max_workers=max_workers):
+            if error is not None:
+                result['failed'][key] = error
+                files.pop(key)
+            else:
+                files[key]['remote_etag'] = etag
+
+        for key, response in self.delete_many(bucket_name, deletes).items():
+            if response['status_code'] != 204:
+                result['failed'][key] = response['content']
+
+        result['uploaded'] = [key for key in result['uploaded'] if key not in result['failed']]
+        result['deleted'] = [key for key in deletes if key not in result['failed']]
+        result['bytes_uploaded'] = sum(files[key]['size'] for key in result['uploaded'])
+
+        manifest['files'] = {local[key][0]: entry for key, entry in files.items()}
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        return result
+
+    def delete_many(self, bucket_name, key_names, max_workers=4):
+
+        """
+        :param bucket_name: S3 Bucket where the keys have to be deleted
+        :param key_names: Iterable of keys to be deleted, may be a generator
+        :param max_workers: Number of delete_objects requests of 1000 keys in flight (optional, default = 4)
+        :return: {key: {"status_code": 204 or 500, "content": "" or error information}} for every key
+        """
+
+        iterator = iter(key_names)
+        batches = iter(lambda: list(itertools.islice(iterator, _BATCH_SIZE)), [])
+
+        def delete_batch(batch):
+            return general.call_with_backoff(
+                self.s3.delete_objects,
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+
+        result = {}
+        for batch, response, error in general.map_concurrently(delete_batch, batches, max_workers=max_workers):
+            failed = {}
+            if error is not None:
+                failed = dict.fromkeys(batch, error)
+            else:
+                failed = {entry['Key']: entry for entry in response.get('Errors', [])}
+
+            for key in batch:
+                if key in failed:
+                    result[key] = {'status_code': 500, 'content': failed[key]}
+                else:
+                    result[key] = {'status_code': 204, 'content': ''}
+
+        return result
+
     def delete(self, bucket_name, key_name):
 
         """
@@ -86,7 +802,7 @@ class S3:
                  Otherwise - status_code = 500 with content = Error information
         """
 
-        return general.handle_action(self.s3.delete_object(Bucket=bucket_name, Key=key_name))
+        return general.handle_action(self.s3.delete_object, Bucket=bucket_name, Key=key_name)
 
 
     def put(self, bucket_name, key_name, payload, content_type):
@@ -99,6 +815,7 @@ class S3:
         :return:
         """
 
-        return general.handle_action(self.s3.put_object(Bucket=bucket_name, Key=key_name, Body=payload, ContentType=content_type))
+        return general.handle_action(self.s3.put_object, Bucket=bucket_name, Key=key_name, Body=payload,
+                                     ContentType=content_type)
 
 
@@ -0,0 +1,112 @@
+"""
+Throughput of the async wrappers in aws_utils.aio against the sync wrappers.
+
+Every call goes to an in-process fake that sleeps LATENCY seconds to simulate the network round trip. The sync
+wrappers make one call after the other, the async wrappers run CONCURRENCY calls at once on the shared executor.
+"max loop lag" is the longest delay of a 1 ms ticker on the event loop while the calls run: the wrappers do not
+block the loop.
+
+Run from the repository root: python -m benchmarks.bench_async
+"""
+import asyncio
+import io
+import json
+import os
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from aws_utils import aio, clients
+from aws_utils.dynamodb import Connection
+from aws_utils.lambda_function import Lambda
+from aws_utils.s3 import S3
+from benchmarks import fake_aws
+
+REGION = 'eu-central-1'
+AWS_ID = '123456789000'
+LATENCY = 0.02
+SYNC_CALLS = 50
+ASYNC_CALLS = 2000
+
+
+def handler(operation, params):
+    if operation == 'GetObject':
+        return {'Body': io.BytesIO(b'{"hello": "world"}'), 'ContentLength': 18, 'ETag': '"etag"'}
+    if operation == 'Invoke':
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps({'ok': True}).encode())}
+    if operation == 'Scan':
+        return {'Items': [{'id': {'S': 'item-1'}}], 'Count': 1, 'ScannedCount': 1}
+    return fake_aws.error('AccessDeniedException')
+
+
+def install():
+    fake_aws.install(clients.get_client('s3'), handler, latency=LATENCY)
+    fake_aws.install(clients.get_client('lambda', REGION), handler, latency=LATENCY)
+    fake_aws.install(clients.get_client('dynamodb'), handler, latency=LATENCY)
+
+
+def calls():
+    s3 = S3(REGION, AWS_ID)
+    function = Lambda(REGION, AWS_ID)
+    connection = Connection(mode='client')
+    return [
+        ('S3.get', lambda: s3.get('bench', 'key')),
+        ('Lambda.execute', lambda: function.execute('bench', {'n': 1}, sync=True)),
+        ('Connection.get', lambda: connection.get('bench'))
+    ]
+
+
+def async_calls():
+    s3 = aio.AsyncS3(REGION, AWS_ID)
+    function = aio.AsyncLambda(REGION, AWS_ID)
+    connection = aio.AsyncConnection(mode='client')
+    return [
+        ('S3.get', lambda: s3.get('bench', 'key')),
+        ('Lambda.execute', lambda: function.execute('bench', {'n': 1}, sync=True)),
+        ('Connection.get', lambda: connection.get('bench'))
+    ]
+
+
+async def ticker(lags, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - started - 0.001)
+
+
+async def measure_async(call):
+    lags = []
+    stop = asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(ASYNC_CALLS)))
+    seconds = time.perf_counter() - started
+    stop.set()
+    await tick
+    return seconds, max(lags, default=0.0)
+
+
+def main():
+    install()
+    print(f"{LATENCY * 1e3:.0f} ms simulated latency, {aio.default_max_workers} executor threads")
+    for name, call in calls():
+        call()
+        started = time.perf_counter()
+        for _ in range(SYNC_CALLS):
+            call()
+        seconds = time.perf_counter() - started
+        print(f"{name + ', sync':<30} {SYNC_CALLS / seconds:10.0f} calls/s")
+
+    async def run_async():
+        for name, call in async_calls():
+            await call()
+            seconds, lag = await measure_async(call)
+            print(f"{name + ', async':<30} {ASYNC_CALLS / seconds:10.0f} calls/s  max loop lag {lag * 1e3:6.1f} ms")
+
+    asyncio.run(run_async())
+
+
+if __name__ == '__main__':
+    main()
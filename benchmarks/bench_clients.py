@@ -0,0 +1,68 @@
+"""
+Cost of constructing the wrapper classes, as a handler does on every request.
+
+"per-request clients" creates the clients exactly like the constructors did before the registry:
+boto3.client()/boto3.resource() on the default session. "shared registry" constructs the wrappers against
+the warm registry in aws_utils.clients.
+
+Run from the repository root: python -m benchmarks.bench_clients
+"""
+import os
+import time
+import tracemalloc
+
+import boto3
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from aws_utils.dynamodb import Connection
+from aws_utils.iam import Policy, Role
+from aws_utils.lambda_function import Lambda
+from aws_utils.s3 import S3
+
+REGION = 'eu-central-1'
+AWS_ID = '123456789000'
+
+
+def construct_all():
+    # Clients are resolved on first use, so touch them to include the registry lookup
+    return [
+        S3(REGION, AWS_ID).s3,
+        Lambda(REGION, AWS_ID).connection,
+        Role(REGION, AWS_ID).iam,
+        Policy(REGION, AWS_ID).iam,
+        Connection().dynamodb
+    ]
+
+
+def per_request():
+    return [
+        boto3.client('s3'),
+        boto3.client('lambda', region_name=REGION),
+        boto3.client('iam', region_name=REGION),
+        boto3.client('iam', region_name=REGION),
+        boto3.resource('dynamodb')
+    ]
+
+
+def measure(name, func, rounds):
+    func()
+    tracemalloc.start()
+    started = time.perf_counter()
+    kept = [func() for _ in range(rounds)]
+    seconds = (time.perf_counter() - started) / rounds
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    print(f"{name:<25} {seconds * 1e3:9.3f} ms/request  peak {peak / 2 ** 20:7.1f} MiB for {rounds} requests")
+
+
+def main(rounds=20):
+    measure('per-request clients', per_request, rounds)
+    measure('shared registry', construct_all, rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Read path of dynamodb.Connection in resource mode versus client mode on wide items.
+
+Every scan returns the same page of wide items from an in-process fake, so the numbers only contain the
+client side cost: request building, (de)serialization and the resource layer.
+
+Run from the repository root: python -m benchmarks.bench_dynamodb_modes
+"""
+import os
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from aws_utils import dynamodb
+from benchmarks import fake_aws
+
+ITEM_COUNT = 100
+ATTRIBUTE_COUNT = 150
+
+
+def wide_item(position):
+    item = {'id': {'S': f"item-{position}"}, 'status': {'S': 'open'}}
+    for attribute in range(ATTRIBUTE_COUNT):
+        if attribute % 3 == 0:
+            item[f"n{attribute}"] = {'N': str(attribute * 1.5)}
+        elif attribute % 3 == 1:
+            item[f"s{attribute}"] = {'S': 'x' * 40}
+        else:
+            item[f"m{attribute}"] = {'M': {'a': {'N': '1'}, 'b': {'L': [{'S': 'y'}, {'N': '2'}]}}}
+    return item
+
+
+ITEMS = [wide_item(position) for position in range(ITEM_COUNT)]
+PROJECTED_ITEMS = [{'id': item['id'], 'status': item['status']} for item in ITEMS]
+
+
+def scan_handler(operation, params):
+    if operation != 'Scan':
+        return fake_aws.error('AccessDeniedException')
+    # The benchmark only projects id and status. Items are copied because the resource layer decodes in place
+    source = PROJECTED_ITEMS if 'ProjectionExpression' in params else ITEMS
+    items = [dict(item) for item in source]
+    return {'Items': items, 'Count': len(items), 'ScannedCount': len(items)}
+
+
+def connection(mode, lazy=False):
+    conn = dynamodb.Connection(mode=mode, lazy=lazy)
+    fake_aws.install(conn.client, scan_handler)
+    return conn
+
+
+def measure(name, func, rounds):
+    func()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    seconds = (time.perf_counter() - started) / rounds
+    print(f"{name:<45} {seconds * 1e3:8.2f} ms/page  {ITEM_COUNT / seconds:10.0f} items/s")
+
+
+def main(rounds=30):
+    resource = connection('resource')
+    client = connection('client')
+    lazy = connection('client', lazy=True)
+
+    def touch(items):
+        return [(item['id'], item['status']) for item in items]
+
+    print(f"{ITEM_COUNT} items per page, {ATTRIBUTE_COUNT + 2} attributes per item")
+    measure('resource mode', lambda: touch(resource.get('bench')), rounds)
+    measure('client mode', lambda: touch(client.get('bench')), rounds)
+    measure('client mode, lazy', lambda: touch(lazy.get('bench')), rounds)
+    measure('resource mode, projection', lambda: touch(resource.get('bench', projection=['id', 'status'])), rounds)
+    measure('client mode, lazy + projection', lambda: touch(lazy.get('bench', projection=['id', 'status'])), rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Per-call cost of building DynamoDB filter and update expressions.
+
+"before" is what a scan paid per call: build the Attr condition tree and let boto3 turn it into
+expression strings. "after" is the compiled path, where the strings come from the expression cache and
+only the values are bound. Update expressions are not cached, "after" builds them with positional placeholders.
+
+Run from the repository root: python -m benchmarks.bench_expressions
+"""
+import timeit
+
+from boto3.dynamodb.conditions import ConditionExpressionBuilder
+
+from aws_utils import dynamodb
+
+FILTERS = {
+    'tenant': {'eq': 'acme'},
+    'created': {'between': ('2024-01-01', '2024-12-31')},
+    'status': {'in': ['open', 'pending', 'blocked']},
+    'name': {'begins_with': 'inv-'},
+    'deleted': {'attribute_not_exists': True}
+}
+UPDATE_DATA = {'status': 'done', 'updated': '2024-10-11 09:30:30', 'retries': 0}
+
+
+def legacy_filter_expression():
+    return ConditionExpressionBuilder().build_expression(dynamodb.build_filter_expression(FILTERS))
+
+
+def legacy_update_expression():
+    update_expression = "SET "
+    expression_attribute_values = {}
+    expression_attribute_names = {}
+    for key, value in UPDATE_DATA.items():
+        update_expression += f"#{key} = :{key}, "
+        expression_attribute_values[f":{key}"] = value
+        expression_attribute_names[f"#{key}"] = key
+    return update_expression.rstrip(', '), expression_attribute_values, expression_attribute_names
+
+
+def uncached_filter_expression():
+    dynamodb.expression_cache.clear()
+    return dynamodb.compile_filter_expression(FILTERS)
+
+
+def measure(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{name:<40} {seconds / number * 1e6:8.2f} us/call")
+
+
+def main(number=20000):
+    measure('filter before (Attr tree + builder)', legacy_filter_expression, number)
+    measure('filter after, cache miss', uncached_filter_expression, number)
+    measure('filter after, cache hit', lambda: dynamodb.compile_filter_expression(FILTERS), number)
+    measure('update before (string concatenation)', legacy_update_expression, number)
+    measure('update after (positional placeholders)', lambda: dynamodb.build_update_expression(UPDATE_DATA), number)
+
+
+if __name__ == '__main__':
+    main()
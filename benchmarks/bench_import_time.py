@@ -0,0 +1,83 @@
+"""
+Import time and cold start of the package, each measured in a fresh interpreter.
+
+The import part runs "python -X importtime -c 'import <module>'" for every module and reports the
+cumulative import time and whether boto3/botocore got imported. The cold start part times importing a
+wrapper, constructing it and its first API call against the in-process fake, which is where boto3 and the
+service model are loaded now.
+
+Run from the repository root: python -m benchmarks.bench_import_time
+With --check the script exits with status 1 when a module imports boto3 or botocore at import time, so a
+regression can fail a CI job.
+"""
+import json
+import os
+import subprocess
+import sys
+
+MODULES = [
+    'aws_utils',
+    'aws_utils.s3',
+    'aws_utils.dynamodb',
+    'aws_utils.lambda_function',
+    'aws_utils.iam',
+    'aws_utils.general'
+]
+
+COLD_START = '''
+import json, os, time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+started = time.perf_counter()
+from aws_utils.s3 import S3
+imported = time.perf_counter()
+s3 = S3('eu-central-1', '123456789000')
+constructed = time.perf_counter()
+from benchmarks import fake_aws
+fake_aws.install(s3.s3, lambda operation, params: {})
+s3.put('bucket', 'key', b'payload', 'text/plain')
+called = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1e3,
+    'construct_ms': (constructed - imported) * 1e3,
+    'first_call_ms': (called - constructed) * 1e3
+}))
+'''
+
+
+def python(*args):
+    env = dict(os.environ)
+    # Bytecode compilation would otherwise be counted as import time
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, env=env, check=True)
+
+
+def import_time(module):
+    python('-c', f"import {module}")
+    lines = python('-X', 'importtime', '-c', f"import {module}").stderr.splitlines()
+    imported = [line.split('|')[-1].strip() for line in lines if line.startswith('import time:')]
+    cumulative = int(lines[-1].split('|')[1])
+    aws_sdk = sorted({name.split('.')[0] for name in imported if name.split('.')[0] in ('boto3', 'botocore')})
+    return cumulative, aws_sdk
+
+
+def main(check=False):
+    failures = []
+    for module in MODULES:
+        cumulative, aws_sdk = import_time(module)
+        print(f"import {module:<28} {cumulative / 1e3:7.1f} ms  aws sdk imported: {', '.join(aws_sdk) or 'no'}")
+        if aws_sdk:
+            failures.append(module)
+
+    cold_start = json.loads(python('-c', COLD_START).stdout)
+    print('cold start S3.put: ' + ', '.join(f"{name} {value:.1f}" for name, value in cold_start.items()))
+
+    if check and failures:
+        print(f"boto3/botocore imported at import time by: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(check='--check' in sys.argv[1:]))
@@ -0,0 +1,345 @@
+"""
+Load test of the wrappers against the in-memory stand-ins of benchmarks.fake_services.
+
+Every scenario runs OPERATIONS calls of one wrapper method on CONCURRENCY threads and reports the throughput,
+the p50/p99 latency of a single call and the peak Python heap allocated while the scenario ran (tracemalloc,
+measured in a second pass so its overhead does not count towards the timings). LATENCY simulates the network
+round trip of every API call and THROTTLE the fraction of calls the services answer with a throttling error,
+so the retry and rate limiting paths are part of the numbers. With --metrics every call also runs through the
+hooks of aws_utils.metrics and the snapshot is added to the results. The uncached IAM scenarios are bound by the client
+side rate limit of general.SERVICE_RATES.
+
+Run from the repository root: python -m benchmarks.bench_suite [--latency 0.005] [--throttle 0.01]
+    [--operations 500] [--concurrency 8] [--only s3.] [--metrics] [--output results.json] [--baseline results.json]
+
+Every operation's result is checked, e.g. the stored object of an upload, and counted under wrong_results when
+it is not correct. The results are printed as JSON. The script exits with status 1 when an operation returned a
+wrong result, or with --baseline when a scenario lost more than --tolerance of the ops/sec of the baseline, so a
+regression can fail a CI job. Run it with --metrics as well, so the instrumented code paths are checked too.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from aws_utils import cache, clients, metrics
+from aws_utils.dynamodb import Connection
+from aws_utils.iam import Policy, Role
+from aws_utils.lambda_function import Lambda
+from aws_utils.s3 import S3, TRANSFER_RETRIES
+from benchmarks import fake_aws, fake_services
+
+REGION = 'eu-central-1'
+AWS_ID = '123456789000'
+BUCKET = 'bench-bucket'
+TABLE = 'bench-table'
+FUNCTION = 'bench-function'
+ROLE = 'bench-role'
+ITEM_COUNT = 250
+LISTED_KEYS = 2500
+OBJECT_SIZE = 16 * 1024
+FILE_SIZE = 256 * 1024
+# Part size of the multipart upload scenario: FILE_SIZE is above it, so the file goes through a multipart upload
+PART_SIZE = 64 * 1024
+
+
+def install(latency, throttle, seed=0):
+
+    """
+    Put a stand-in behind the shared client of every service.
+
+    :return: {service name: stand-in}
+    """
+
+    services = {
+        's3': fake_services.FakeS3(throttle, seed),
+        'dynamodb': fake_services.FakeDynamoDB(throttle, seed),
+        'lambda': fake_services.FakeLambda(throttle, seed, REGION, AWS_ID),
+        'iam': fake_services.FakeIAM(throttle, seed, AWS_ID)
+    }
+
+    services['s3'].put_object(BUCKET, 'objects/get', os.urandom(OBJECT_SIZE))
+    for position in range(LISTED_KEYS):
+        services['s3'].put_object(BUCKET, f"listed/{position:05d}.json", b'{}')
+
+    services['dynamodb'].create_table(TABLE)
+    services['dynamodb'].put_items(TABLE, [
+        {'id': {'S': f"item-{position}"}, 'status': {'S': 'open'}, 'count': {'N': str(position)}}
+        for position in range(ITEM_COUNT)
+    ])
+
+    services['lambda'].create_function(FUNCTION)
+    services['iam'].create_role(ROLE)
+    services['iam'].create_policy('bench-policy')
+
+    # The wrappers create their clients in REGION or in the region of the environment
+    for service, stand_in in services.items():
+        for region in (None, REGION):
+            fake_aws.install(clients.get_client(service, region), stand_in, latency=latency)
+    fake_aws.install(clients.get_client('s3', retries=TRANSFER_RETRIES), services['s3'], latency=latency)
+    return services
+
+
+def scenarios(workdir, services):
+
+    """
+    :return: list of (name, service, call, check) where call(position) runs one operation and returns its response,
+             and check(position, response) tells whether a successful response and the state it left are correct
+    """
+
+    connection = Connection(mode='client')
+    s3 = S3(REGION, AWS_ID)
+    function = Lambda(REGION, AWS_ID)
+    role = Role(REGION, AWS_ID)
+    policy = Policy(REGION, AWS_ID)
+    policy_arn = f"arn:aws:iam::{AWS_ID}:policy/bench-policy"
+    objects = services['s3'].objects
+    payload = os.urandom(OBJECT_SIZE)
+    file_path = os.path.join(workdir, 'upload.bin')
+    with open(file_path, 'wb') as f:
+        f.write(os.urandom(FILE_SIZE))
+
+    def key(position):
+        return f"item-{position % ITEM_COUNT}"
+
+    def stored(key_name, size):
+        return len(objects.get((BUCKET, key_name), (b'',))[0]) == size
+
+    def read(response):
+        # Reading the body is part of the operation, the check only looks at the result
+        response['content']['Body'] = response['content']['Body'].read()
+        return response
+
+    def invoke(position):
+        response = function.execute(FUNCTION, {'position': position}, sync=True)
+        if response['status_code'] == 200:
+            response['content']['Payload'] = json.loads(response['content']['Payload'].read())
+        return response
+
+    return [
+        ('dynamodb.Connection.get (scan)', 'dynamodb',
+         lambda position: connection.get(TABLE, filters={'status': {'eq': 'open'}}),
+         lambda position, items: len(items) == ITEM_COUNT),
+        ('dynamodb.Connection.get (key)', 'dynamodb',
+         lambda position: connection.get(TABLE, filters={'id': {'eq': key(position)}}),
+         lambda position, items: [item['id'] for item in items] == [key(position)]),
+        ('dynamodb.Connection.update', 'dynamodb',
+         lambda position: connection.update(TABLE, None, {'status': 'done'}, keys=[key(position)]),
+         lambda position, updated: updated == {key(position): {'status': 'done'}}),
+        ('s3.S3.get', 's3',
+         lambda position: read(s3.get(BUCKET, 'objects/get')),
+         lambda position, response: response['content']['Body'] == objects[(BUCKET, 'objects/get')][0]),
+        ('s3.S3.put', 's3',
+         lambda position: s3.put(BUCKET, f"objects/put-{position}", payload, 'text/plain'),
+         lambda position, response: objects[(BUCKET, f"objects/put-{position}")][0] == payload),
+        ('s3.S3.list', 's3',
+         lambda position: s3.list(BUCKET, prefix='listed/'),
+         lambda position, response: response['content']['KeyCount'] == LISTED_KEYS),
+        ('s3.S3.create', 's3',
+         lambda position: s3.create(BUCKET, f"objects/create-{position}", file_path),
+         lambda position, response: stored(f"objects/create-{position}", FILE_SIZE)),
+        ('s3.S3.upload (multipart)', 's3',
+         lambda position: s3.upload(BUCKET, f"objects/upload-{position}", file_path, part_size=PART_SIZE),
+         lambda position, response: stored(f"objects/upload-{position}", FILE_SIZE)),
+        ('lambda.Lambda.execute', 'lambda',
+         invoke,
+         lambda position, response: response['content']['Payload'] == {
+             'received': len(json.dumps({'position': position}))
+         }),
+        ('iam.Role.get', 'iam',
+         lambda position: role.get(ROLE, use_cache=False),
+         lambda position, response: response['content']['Role']['RoleName'] == ROLE),
+        ('iam.Policy.get', 'iam',
+         lambda position: policy.get(policy_arn, use_cache=False),
+         lambda position, response: response['content']['Policy']['Arn'] == policy_arn),
+        ('iam.Role.get (cached)', 'iam',
+         lambda position: role.get(ROLE),
+         lambda position, response: response['content']['Role']['RoleName'] == ROLE)
+    ]
+
+
+def failed(response):
+    if isinstance(response, dict) and 'status_code' in response:
+        return response['status_code'] >= 300
+    return False
+
+
+def run(call, check, operations, concurrency):
+
+    """
+    :return: (seconds, sorted latencies in seconds, number of failed operations, number of operations that
+             succeeded with a wrong result)
+    """
+
+    positions = iter(range(operations))
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    wrong = [0]
+
+    def worker():
+        while True:
+            with lock:
+                position = next(positions, None)
+            if position is None:
+                return
+            started = time.perf_counter()
+            try:
+                response = call(position)
+                error = failed(response)
+            except Exception:
+                error = True
+            latency = time.perf_counter() - started
+            try:
+                incorrect = not error and not check(position, response)
+            except Exception:
+                incorrect = True
+            with lock:
+                latencies.append(latency)
+                errors[0] += error
+                wrong[0] += incorrect
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sorted(latencies), errors[0], wrong[0]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_memory(call, check, operations, concurrency):
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        run(call, check, operations, concurrency)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(name, call, check, stand_in, operations, concurrency):
+    # Warm up: clients, service models and the caches of the wrappers
+    run(call, check, concurrency, concurrency)
+    stand_in.reset_counters()
+    seconds, latencies, errors, wrong = run(call, check, operations, concurrency)
+    api_calls, throttled = stand_in.calls, stand_in.throttled
+    return {
+        'name': name,
+        'operations': operations,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 4),
+        'ops_per_second': round(operations / seconds, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1e3, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1e3, 3),
+        'max_ms': round(latencies[-1] * 1e3, 3),
+        'errors': errors,
+        'wrong_results': wrong,
+        'api_calls': api_calls,
+        'throttled_calls': throttled,
+        'peak_memory_bytes': peak_memory(call, check, operations, concurrency)
+    }
+
+
+def regressions(results, baseline, tolerance):
+
+    """
+    :return: list of (name, baseline ops/sec, ops/sec) of the scenarios that got slower than tolerance allows
+    """
+
+    previous = {result['name']: result for result in baseline['results']}
+    slower = []
+    for result in results['results']:
+        before = previous.get(result['name'])
+        if before is not None and result['ops_per_second'] < before['ops_per_second'] * (1 - tolerance):
+            slower.append((result['name'], before['ops_per_second'], result['ops_per_second']))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load test of the aws_utils wrappers')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every API call takes (default 0)')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Fraction of throttled API calls (default 0)')
+    parser.add_argument('--operations', type=int, default=500, help='Operations per scenario (default 500)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Threads per scenario (default 8)')
+    parser.add_argument('--only', default='', help='Only run the scenarios whose name contains this text')
+    parser.add_argument('--metrics', action='store_true', help='Record every call with aws_utils.metrics')
+    parser.add_argument('--output', help='Also write the results to this file')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed loss of ops/sec against the baseline (default 0.2)')
+    args = parser.parse_args(argv)
+
+    services = install(args.latency, args.throttle)
+    results = {
+        'config': {
+            'latency': args.latency,
+            'throttle': args.throttle,
+            'operations': args.operations,
+            'concurrency': args.concurrency,
+            'metrics': args.metrics,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'results': []
+    }
+    if args.metrics:
+        metrics.enable()
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, service, call, check in scenarios(workdir, services):
+            if args.only not in name:
+                continue
+            cache.metadata_cache.clear()
+            result = benchmark(name, call, check, services[service], args.operations, args.concurrency)
+            results['results'].append(result)
+            print(f"{name:<35} {result['ops_per_second']:10.1f} ops/s  p50 {result['p50_ms']:8.2f} ms  "
+                  f"p99 {result['p99_ms']:8.2f} ms  peak {result['peak_memory_bytes'] / 1024:8.0f} KB"
+                  f"  errors {result['errors']}  wrong {result['wrong_results']}",
+                  file=sys.stderr)
+
+    if args.metrics:
+        results['metrics'] = metrics.snapshot()
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+    status = 0
+    wrong = [result['name'] for result in results['results'] if result['wrong_results']]
+    if wrong:
+        print(f"wrong results: {', '.join(wrong)}", file=sys.stderr)
+        status = 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = [name for name in ('latency', 'throttle', 'operations', 'concurrency', 'metrics')
+                   if baseline['config'].get(name) != results['config'][name]]
+        if changed:
+            print(f"warning: the baseline ran with a different {', '.join(changed)}", file=sys.stderr)
+        slower = regressions(results, baseline, args.tolerance)
+        for name, before, after in slower:
+            print(f"regression: {name} {before} -> {after} ops/s", file=sys.stderr)
+        if slower:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
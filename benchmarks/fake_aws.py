@@ -0,0 +1,60 @@
+"""
+In-process stand-in for AWS used by the benchmarks.
+
+install() short-circuits every API call of a botocore client before anything goes over the wire. The
+handler receives the operation name and the API parameters (after boto3 serialized them) and returns the
+parsed response, or error() for a failing call.
+
+Answering from before-call skips the retry handler of botocore, so install() retries throttled calls itself, up to
+the total_max_attempts of the client's retries config, like the standard retry mode does.
+"""
+import time
+
+from aws_utils.general import THROTTLING_ERROR_CODES
+
+# Total attempts of a client without a retries config: 4 retries in the legacy retry mode of botocore
+DEFAULT_ATTEMPTS = 5
+
+
+class _HTTPResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+
+def error(code, message='', status_code=400):
+    return {
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status_code}
+    }
+
+
+def install(client, handler, latency=0.0):
+
+    """
+    :param client: botocore client, e.g. boto3.client('dynamodb') or resource.meta.client
+    :param handler: callable(operation_name, params) returning the parsed response dict
+    :param latency: Seconds every call sleeps to simulate the network round trip (optional)
+    """
+
+    def capture_params(params, context, **kwargs):
+        context['fake_aws_params'] = params
+
+    retries = client.meta.config.retries or {}
+    attempts = retries.get('total_max_attempts', retries.get('max_attempts', DEFAULT_ATTEMPTS - 1) + 1)
+
+    def before_call(model, context, **kwargs):
+        for attempt in range(attempts):
+            if latency:
+                time.sleep(latency)
+            response = handler(model.name, context.get('fake_aws_params', {}))
+            if response.get('Error', {}).get('Code') not in THROTTLING_ERROR_CODES:
+                break
+        response.setdefault('ResponseMetadata', {}).setdefault('HTTPStatusCode', 200)
+        response['ResponseMetadata'].setdefault('RetryAttempts', attempt)
+        return _HTTPResponse(response['ResponseMetadata']['HTTPStatusCode']), response
+
+    client.meta.events.register_last('before-parameter-build', capture_params)
+    client.meta.events.register('before-call', before_call)
+    return client
@@ -0,0 +1,348 @@
+"""
+In-memory stand-ins for S3, DynamoDB, Lambda and IAM, used as fake_aws handlers by the benchmarks.
+
+Every service keeps its state in dicts, so the wrappers run their real request building, serialization and
+retry code against it. A configurable fraction of the calls is answered with the throttling error of the
+service, which exercises general.call_with_backoff and the rate limiters. The services only implement what
+the benchmarks need: DynamoDB scans do not evaluate FilterExpression, and ConditionExpression is reduced to
+"the item exists".
+"""
+import base64
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+
+from benchmarks import fake_aws
+
+
+class FakeService:
+    throttling_error_code = 'ThrottlingException'
+
+    def __init__(self, throttle=0.0, seed=0):
+
+        """
+        :param throttle: Fraction of the calls answered with a throttling error, e.g. 0.01 (optional, default = 0)
+        :param seed: Seed of the throttling decisions, so runs are repeatable (optional)
+        """
+
+        self.throttle = throttle
+        self.calls = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, operation, params):
+        with self._lock:
+            self.calls += 1
+            throttled = self.throttle and self._random.random() < self.throttle
+            if throttled:
+                self.throttled += 1
+        if throttled:
+            return fake_aws.error(self.throttling_error_code, 'Rate exceeded')
+        handler = getattr(self, operation, None)
+        if handler is None:
+            return fake_aws.error('InvalidAction', f"{type(self).__name__} does not implement {operation}")
+        with self._lock:
+            return handler(params)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = 0
+            self.throttled = 0
+
+
+def _etag(data):
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+def _read(body):
+    if hasattr(body, 'read'):
+        return body.read()
+    return body.encode() if isinstance(body, str) else bytes(body)
+
+
+class FakeS3(FakeService):
+    throttling_error_code = 'SlowDown'
+
+    def __init__(self, throttle=0.0, seed=0):
+        super().__init__(throttle, seed)
+        self.objects = {}
+        self.uploads = {}
+        self.upload_count = 0
+
+    def put_object(self, bucket_name, key_name, data, metadata=None):
+        self.objects[(bucket_name, key_name)] = (data, _etag(data), metadata or {})
+
+    def PutObject(self, params):
+        self.put_object(params['Bucket'], params['Key'], _read(params.get('Body', b'')), params.get('Metadata'))
+        return {'ETag': self.objects[(params['Bucket'], params['Key'])][1]}
+
+    def HeadObject(self, params):
+        entry = self.objects.get((params['Bucket'], params['Key']))
+        if entry is None:
+            return fake_aws.error('404', 'Not Found', 404)
+        return {'ContentLength': len(entry[0]), 'ETag': entry[1], 'Metadata': entry[2]}
+
+    def GetObject(self, params):
+        from botocore.response import StreamingBody
+
+        entry = self.objects.get((params['Bucket'], params['Key']))
+        if entry is None:
+            return fake_aws.error('NoSuchKey', 'The specified key does not exist.', 404)
+        data, etag, metadata = entry
+        if params.get('IfNoneMatch') == etag:
+            return fake_aws.error('304', 'Not Modified', 304)
+        if 'Range' in params:
+            start, end = params['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ContentLength': len(data), 'ETag': etag,
+                'Metadata': metadata}
+
+    def CreateMultipartUpload(self, params):
+        self.upload_count += 1
+        upload_id = str(self.upload_count)
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id, 'Bucket': params['Bucket'], 'Key': params['Key']}
+
+    def UploadPart(self, params):
+        data = _read(params['Body'])
+        self.uploads[params['UploadId']][params['PartNumber']] = data
+        return {'ETag': _etag(data)}
+
+    def CompleteMultipartUpload(self, params):
+        parts = self.uploads.pop(params['UploadId'])
+        numbers = sorted(parts)
+        digest = hashlib.md5(b''.join(hashlib.md5(parts[number]).digest() for number in numbers)).hexdigest()
+        etag = f'"{digest}-{len(numbers)}"'
+        self.objects[(params['Bucket'], params['Key'])] = (b''.join(parts[number] for number in numbers), etag, {})
+        return {'ETag': etag}
+
+    def AbortMultipartUpload(self, params):
+        self.uploads.pop(params['UploadId'], None)
+        return {}
+
+    def DeleteObject(self, params):
+        self.objects.pop((params['Bucket'], params['Key']), None)
+        return {'ResponseMetadata': {'HTTPStatusCode': 204}}
+
+    def DeleteObjects(self, params):
+        for entry in params['Delete']['Objects']:
+            self.objects.pop((params['Bucket'], entry['Key']), None)
+        if params['Delete'].get('Quiet'):
+            return {}
+        return {'Deleted': [{'Key': entry['Key']} for entry in params['Delete']['Objects']]}
+
+    def ListObjectsV2(self, params):
+        prefix = params.get('Prefix', '')
+        delimiter = params.get('Delimiter')
+        after = params.get('ContinuationToken') or params.get('StartAfter') or ''
+        max_keys = params.get('MaxKeys', 1000)
+        keys = sorted(key for bucket_name, key in self.objects
+                      if bucket_name == params['Bucket'] and key.startswith(prefix) and key > after)
+
+        contents = []
+        common_prefixes = []
+        token = None
+        truncated = False
+        for key in keys:
+            rest = key[len(prefix):]
+            common_prefix = prefix + rest.split(delimiter)[0] + delimiter if delimiter and delimiter in rest else None
+            # Keys with the same common prefix are adjacent and listed once
+            if common_prefix is not None and common_prefixes and common_prefixes[-1]['Prefix'] == common_prefix:
+                continue
+            if len(contents) + len(common_prefixes) >= max_keys:
+                truncated = True
+                break
+            if common_prefix is not None:
+                common_prefixes.append({'Prefix': common_prefix})
+                token = common_prefix + '\uffff'
+            else:
+                data, etag, _ = self.objects[(params['Bucket'], key)]
+                contents.append({'Key': key, 'Size': len(data), 'ETag': etag})
+                token = key
+
+        response = {'KeyCount': len(contents) + len(common_prefixes), 'IsTruncated': truncated}
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = common_prefixes
+        if truncated:
+            response['NextContinuationToken'] = token
+        return response
+
+
+class FakeDynamoDB(FakeService):
+    throttling_error_code = 'ProvisionedThroughputExceededException'
+
+    def __init__(self, throttle=0.0, seed=0):
+        super().__init__(throttle, seed)
+        self.tables = {}
+
+    def create_table(self, table_name, hash_key='id', range_key=None):
+        key_schema = [{'AttributeName': hash_key, 'KeyType': 'HASH'}]
+        if range_key is not None:
+            key_schema.append({'AttributeName': range_key, 'KeyType': 'RANGE'})
+        self.tables[table_name] = {'KeySchema': key_schema, 'items': {}}
+
+    def _key(self, table, item):
+        return tuple(json.dumps(item[key['AttributeName']], sort_keys=True) for key in table['KeySchema'])
+
+    def put_items(self, table_name, items):
+
+        """
+        :param items: Items in the DynamoDB JSON format, e.g. {"id": {"S": "a"}}
+        """
+
+        table = self.tables[table_name]
+        for item in items:
+            table['items'][self._key(table, item)] = item
+
+    def _table(self, params):
+        return self.tables.get(params['TableName'])
+
+    def _not_found(self, params):
+        return fake_aws.error('ResourceNotFoundException', f"Requested resource not found: {params['TableName']}")
+
+    def DescribeTable(self, params):
+        table = self._table(params)
+        if table is None:
+            return self._not_found(params)
+        return {'Table': {'TableName': params['TableName'], 'KeySchema': table['KeySchema'],
+                          'TableStatus': 'ACTIVE', 'ItemCount': len(table['items'])}}
+
+    def GetItem(self, params):
+        table = self._table(params)
+        if table is None:
+            return self._not_found(params)
+        item = table['items'].get(self._key(table, params['Key']))
+        # Items are copied because the resource layer decodes responses in place
+        return {} if item is None else {'Item': dict(item)}
+
+    def PutItem(self, params):
+        table = self._table(params)
+        if table is None:
+            return self._not_found(params)
+        table['items'][self._key(table, params['Item'])] = params['Item']
+        return {}
+
+    def Scan(self, params):
+        table = self._table(params)
+        if table is None:
+            return self._not_found(params)
+        keys = sorted(table['items'])
+        if 'ExclusiveStartKey' in params:
+            start = self._key(table, params['ExclusiveStartKey'])
+            keys = [key for key in keys if key > start]
+        limit = params.get('Limit', 100)
+        items = [dict(table['items'][key]) for key in keys[:limit]]
+        response = {'Items': items, 'Count': len(items), 'ScannedCount': len(items)}
+        if len(keys) > limit:
+            response['LastEvaluatedKey'] = {key['AttributeName']: items[-1][key['AttributeName']]
+                                            for key in table['KeySchema']}
+        return response
+
+    def UpdateItem(self, params):
+        table = self._table(params)
+        if table is None:
+            return self._not_found(params)
+        key = self._key(table, params['Key'])
+        item = table['items'].get(key)
+        if item is None and 'ConditionExpression' in params:
+            return fake_aws.error('ConditionalCheckFailedException', 'The conditional request failed')
+        item = dict(item or params['Key'])
+        names = params.get('ExpressionAttributeNames', {})
+        values = params.get('ExpressionAttributeValues', {})
+        updated = {}
+        for name, value in re.findall(r'(#\w+)\s*=\s*(:\w+)', params.get('UpdateExpression', '')):
+            item[names[name]] = updated[names[name]] = values[value]
+        table['items'][key] = item
+        return {'Attributes': updated}
+
+
+class FakeLambda(FakeService):
+    throttling_error_code = 'TooManyRequestsException'
+
+    def __init__(self, throttle=0.0, seed=0, region='eu-central-1', aws_id='123456789000'):
+        super().__init__(throttle, seed)
+        self.region = region
+        self.aws_id = aws_id
+        self.functions = {}
+
+    def create_function(self, name, code=b''):
+        self.functions[name] = {
+            'FunctionName': name,
+            'FunctionArn': f"arn:aws:lambda:{self.region}:{self.aws_id}:function:{name}",
+            'CodeSha256': base64.b64encode(hashlib.sha256(code).digest()).decode(),
+            'CodeSize': len(code)
+        }
+
+    def _function(self, params):
+        return self.functions.get(params['FunctionName'].split(':function:')[-1])
+
+    def GetFunction(self, params):
+        configuration = self._function(params)
+        if configuration is None:
+            return fake_aws.error('ResourceNotFoundException', f"Function not found: {params['FunctionName']}", 404)
+        return {'Configuration': dict(configuration)}
+
+    def ListFunctions(self, params):
+        return {'Functions': [dict(configuration) for configuration in self.functions.values()]}
+
+    def Invoke(self, params):
+        if self._function(params) is None:
+            return fake_aws.error('ResourceNotFoundException', f"Function not found: {params['FunctionName']}", 404)
+        if params.get('InvocationType') == 'Event':
+            return {'StatusCode': 202, 'Payload': io.BytesIO(b''), 'ResponseMetadata': {'HTTPStatusCode': 202}}
+        # The function echoes the size of its event
+        payload = _read(params.get('Payload', b''))
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps({'received': len(payload)}).encode())}
+
+
+class FakeIAM(FakeService):
+    throttling_error_code = 'Throttling'
+
+    def __init__(self, throttle=0.0, seed=0, aws_id='123456789000'):
+        super().__init__(throttle, seed)
+        self.aws_id = aws_id
+        self.roles = {}
+        self.policies = {}
+
+    def create_role(self, name, services=('lambda.amazonaws.com',)):
+        self.roles[name] = {
+            'RoleName': name,
+            'RoleId': f"AROA{hashlib.md5(name.encode()).hexdigest()[:16].upper()}",
+            'Arn': f"arn:aws:iam::{self.aws_id}:role/{name}",
+            'Path': '/',
+            'AssumeRolePolicyDocument': json.dumps({
+                'Version': '2012-10-17',
+                'Statement': [{'Effect': 'Allow', 'Principal': {'Service': list(services)}, 'Action': 'sts:AssumeRole'}]
+            })
+        }
+
+    def create_policy(self, name):
+        arn = f"arn:aws:iam::{self.aws_id}:policy/{name}"
+        self.policies[arn] = {
+            'PolicyName': name,
+            'PolicyId': f"ANPA{hashlib.md5(name.encode()).hexdigest()[:16].upper()}",
+            'Arn': arn,
+            'Path': '/',
+            'DefaultVersionId': 'v1',
+            'AttachmentCount': 0,
+            'IsAttachable': True
+        }
+        return arn
+
+    def GetRole(self, params):
+        role = self.roles.get(params['RoleName'])
+        if role is None:
+            return fake_aws.error('NoSuchEntity', f"The role with name {params['RoleName']} cannot be found.", 404)
+        return {'Role': dict(role)}
+
+    def GetPolicy(self, params):
+        policy = self.policies.get(params['PolicyArn'])
+        if policy is None:
+            return fake_aws.error('NoSuchEntity', f"Policy {params['PolicyArn']} was not found.", 404)
+        return {'Policy': dict(policy)}